@@ -0,0 +1,144 @@
+import asyncio
+import functools
+import logging
+import os
+import stat
+import time
+import uuid
+
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types.input_file import FSInputFile
+
+from data import (
+    data_versions, get_houses_data, get_pdf_documents, set_presentation_file_id, set_pdf_file_id, acquire_lease
+)
+from metrics import transfer_bytes_total
+from uploads import file_sha256
+
+
+# Как часто проверяем, не изменился ли каталог, и как часто перепроверяем все файлы, в секундах
+CHECK_INTERVAL = 5
+RESCAN_INTERVAL = 600
+
+# file_id сохраняет и файлы загружает только процесс, арендовавший проверку. Аренда продлевается
+# каждые CHECK_INTERVAL секунд, после остановки процесса ее через LEASE_SECONDS берет другой
+LEASE_NAME = 'asset_scanner'
+LEASE_SECONDS = 30
+
+# Результаты последней проверки файлов: путь -> {'size', 'mtime', 'sha256', 'file_id'}, None если файла нет.
+# Пути, которые еще не проверялись, в индексе отсутствуют
+asset_index = {}
+
+
+def presentation_path(house, file_name):
+    return f"./{house}/{file_name}"
+
+
+# Доступность файла по данным последней проверки, без обращения к диску.
+# Непроверенные файлы считаются доступными
+def is_available(path):
+    return asset_index.get(path, True) is not None
+
+
+# Размер, время изменения и контрольная сумма файла, None если файла нет.
+# Если размер и время изменения не поменялись, контрольная сумма берется из прошлой проверки
+def _check_file(path, known):
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+
+    if known and known['size'] == file_stat.st_size and known['mtime'] == file_stat.st_mtime:
+        sha256 = known['sha256']
+    else:
+        sha256 = file_sha256(path)
+    return {'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'sha256': sha256}
+
+
+# Фоновая проверка файлов презентаций и правил при запуске и после изменения каталога.
+# Отсутствующие файлы отмечаются в индексе и в логе, а файлы без file_id заранее загружаются
+# в служебный чат chat_id, чтобы пользователи получали документ по готовому file_id.
+# Индекс ведет каждый процесс, а загрузки и запись file_id - только владелец аренды
+class AssetScanner:
+    def __init__(self, bot, chat_id=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.owner = uuid.uuid4().hex
+
+    # Документы из базы: (путь, file_id, функция сохранения нового file_id).
+    # Функция сохранения ничего не меняет, если в базе за это время указали другой файл
+    async def _documents(self):
+        documents = []
+        for house, info in (await get_houses_data()).items():
+            if info['presentation']:
+                documents.append((
+                    presentation_path(house, info['presentation']), info['presentation_file_id'],
+                    functools.partial(set_presentation_file_id, house, presentation=info['presentation'])
+                ))
+        for command, (file_name, file_id) in (await get_pdf_documents()).items():
+            if file_name:
+                documents.append((file_name, file_id, functools.partial(set_pdf_file_id, command, filename=file_name)))
+        return documents
+
+    async def scan(self, writer=True):
+        documents = await self._documents()
+        for path, file_id, save_file_id in documents:
+            known = asset_index.get(path)
+            info = await asyncio.to_thread(_check_file, path, known)
+            if info is None:
+                if path not in asset_index or known is not None:
+                    logging.warning("Файл %s не найден", path)
+                asset_index[path] = None
+                continue
+
+            # Файл заменили на диске в обход бота: сохраненный file_id указывает на старое содержимое
+            if writer and known and file_id and known['file_id'] == file_id and known['sha256'] != info['sha256']:
+                logging.info("Файл %s изменился, file_id сброшен", path)
+                file_id = None
+                await save_file_id(None)
+
+            if writer and not file_id and self.chat_id:
+                file_id = await self._upload(path)
+                if file_id:
+                    await save_file_id(file_id)
+
+            info['file_id'] = file_id
+            asset_index[path] = info
+
+        # Файлы, которые больше не упоминаются в базе, убираем из индекса
+        paths = {path for path, _, _ in documents}
+        for path in list(asset_index):
+            if path not in paths:
+                del asset_index[path]
+
+    async def _upload(self, path):
+        try:
+            message = await self.bot.send_document(self.chat_id, FSInputFile(path), disable_notification=True)
+        except (TelegramAPIError, OSError):
+            logging.exception("Не удалось заранее загрузить %s", path)
+            return None
+        transfer_bytes_total.inc(message.document.file_size or 0, direction='upload')
+        return message.document.file_id
+
+    async def run(self, check_interval=CHECK_INTERVAL, rescan_interval=RESCAN_INTERVAL):
+        versions = None
+        scanned_at = 0
+        while True:
+            try:
+                writer = await acquire_lease(LEASE_NAME, self.owner, LEASE_SECONDS)
+            except Exception:
+                logging.exception("Не удалось продлить аренду проверки файлов")
+                writer = False
+
+            # Процесс, только что получивший аренду, сразу догружает недостающие file_id
+            current = (data_versions['houses'], data_versions['pdf_files'], writer)
+            if current != versions or time.monotonic() - scanned_at >= rescan_interval:
+                versions = current
+                scanned_at = time.monotonic()
+                try:
+                    await self.scan(writer)
+                except Exception:
+                    logging.exception("Ошибка проверки файлов документов")
+            await asyncio.sleep(check_interval)
@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update, Message, Chat, User, CallbackQuery, Document
+
+from metrics import handler_seconds
+from ratelimit import KeyedTokenBuckets
+
+
+# Нагрузочный тест: синтетические обновления подаются прямо в диспетчер из main.py,
+# запросы к Telegram обрабатывает заглушка без сети. Базы копируются во временный каталог,
+# поэтому рабочие data.db и users.db не меняются.
+#
+#   python bench.py                        все сценарии
+#   python bench.py browse -u 500 -c 50    один сценарий, 500 пользователей, 50 одновременно
+#   python bench.py --api-latency 50       имитация задержки ответа Telegram в миллисекундах
+#   python bench.py --rate-limit           с рабочим ограничением частоты запросов от одного чата
+#
+# Для каждого сценария считается, сколько обновлений дошло до обработчиков. Без --rate-limit
+# ни одно обновление не должно теряться, иначе тест завершается с ошибкой
+
+
+# Заглушка Bot API: отвечает на запросы без обращения к сети
+class FakeSession(BaseSession):
+    def __init__(self, latency=0):
+        super().__init__()
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.requests = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        name = type(method).__name__
+        if name == 'GetMe':
+            return User(id=1, is_bot=True, first_name='bench')
+        if method.__returning__ is bool:
+            return True
+        if name in ('SendMessage', 'SendDocument', 'EditMessageText', 'EditMessageReplyMarkup'):
+            message_id = next(self.message_ids)
+            document = None
+            if name == 'SendDocument':
+                document = Document(file_id=f'bench-file-{message_id}', file_unique_id=f'bench-{message_id}', file_size=0)
+            chat = Chat(id=getattr(method, 'chat_id', None) or 1, type='private')
+            return Message(
+                message_id=message_id, date=datetime.datetime.now(), chat=chat,
+                text=getattr(method, 'text', None), document=document
+            ).as_(bot)
+        return None
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+def make_message(user_id, text=None, **kwargs):
+    user = User(id=user_id, is_bot=False, first_name=f'user{user_id}')
+    chat = Chat(id=user_id, type='private')
+    message = Message(
+        message_id=next(message_ids), date=datetime.datetime.now(), chat=chat, from_user=user, text=text, **kwargs
+    )
+    return Update(update_id=next(update_ids), message=message)
+
+
+def make_callback(user_id, data):
+    user = User(id=user_id, is_bot=False, first_name=f'user{user_id}')
+    chat = Chat(id=user_id, type='private')
+    message = Message(message_id=next(message_ids), date=datetime.datetime.now(), chat=chat, from_user=user, text='')
+    callback = CallbackQuery(id=str(next(update_ids)), from_user=user, chat_instance='bench', data=data, message=message)
+    return Update(update_id=next(update_ids), callback_query=callback)
+
+
+# Сценарии: функция возвращает последовательность обновлений от одного пользователя.
+# house_ids - id домов из каталога
+def scenario_start(user_id, house_ids):
+    return [make_message(user_id, '/start')]
+
+
+def scenario_register(user_id, house_ids):
+    return [
+        make_message(user_id, '/start'),
+        make_message(user_id, '+70000000000'),
+        make_message(user_id, 'Имя'),
+        make_message(user_id, 'Фамилия'),
+        make_message(user_id, 'Компания'),
+        make_message(user_id, f'user{user_id}@example.com'),
+    ]
+
+
+def scenario_browse(user_id, house_ids):
+    house_id = house_ids[user_id % len(house_ids)]
+    return [
+        make_callback(user_id, 'main_menu'),
+        make_callback(user_id, 'houses_for_sale'),
+        make_callback(user_id, f'house:{house_id}'),
+        # Возврат к списку кнопкой НАЗАД не должен считаться повторным нажатием
+        make_callback(user_id, 'houses_for_sale'),
+        make_callback(user_id, 'lot_of_the_week'),
+        make_callback(user_id, 'rules'),
+    ]
+
+
+def scenario_presentation(user_id, house_ids):
+    house_id = house_ids[user_id % len(house_ids)]
+    return [make_callback(user_id, f'presentation:{house_id}')]
+
+
+def scenario_admin(user_id, house_ids):
+    house_id = house_ids[user_id % len(house_ids)]
+    return [
+        make_message(user_id, '/edit_homes'),
+        make_callback(user_id, f'edit_house:{house_id}'),
+        make_callback(user_id, f'edit_link:video:{house_id}'),
+        make_message(user_id, f'https://example.com/video/{user_id}'),
+    ]
+
+
+SCENARIOS = {
+    'start': scenario_start,
+    'register': scenario_register,
+    'browse': scenario_browse,
+    'presentation': scenario_presentation,
+    'admin': scenario_admin,
+}
+
+
+# Сколько обновлений дошло до обработчиков: сообщения считает HandlerMetricsMiddleware,
+# нажатия на кнопки - CallbackRouter
+def handled_updates():
+    return sum(value['count'] for value in handler_seconds.snapshot().values())
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_scenario(bot, dp, name, users, concurrency, house_ids, first_user_id):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    # Обновления одного пользователя идут по очереди, разные пользователи - параллельно
+    async def run_user(user_id):
+        nonlocal errors
+        async with semaphore:
+            for update in SCENARIOS[name](user_id, house_ids):
+                started_at = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception:
+                    errors += 1
+                    logging.exception("Ошибка в сценарии %s", name)
+                latencies.append(time.perf_counter() - started_at)
+
+    handled_before = handled_updates()
+    started_at = time.perf_counter()
+    await asyncio.gather(*(run_user(first_user_id + i) for i in range(users)))
+    elapsed = time.perf_counter() - started_at
+    handled = handled_updates() - handled_before
+
+    return {
+        'scenario': name,
+        'updates': len(latencies),
+        'handled': handled,
+        'dropped': len(latencies) - handled,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+async def run(args):
+    import main
+
+    await main.migrate()
+    await main.load_houses_data()
+    bot = main.create_bot()
+    bot.session = FakeSession(args.api_latency / 1000)
+    dp = main.create_dispatcher(bot)
+
+    # Синтетические пользователи шлют обновления без пауз, поэтому общее ограничение частоты
+    # по умолчанию снимается. Склейка повторных нажатий и лимит на отправку файлов остаются
+    if not args.rate_limit:
+        main.throttling.buckets = KeyedTokenBuckets(10 ** 9, 10 ** 9)
+
+    if not await main.get_houses_data():
+        await main.add_house('bench', '', '', '', '', '', '', '', '', '')
+    house_ids = [info['id'] for info in (await main.get_houses_data()).values()]
+
+    results = []
+    # У каждого сценария свои пользователи, чтобы ограничение частоты не смешивало сценарии
+    first_user_id = 10 ** 9
+    try:
+        for name in args.scenarios or SCENARIOS:
+            result = await run_scenario(bot, dp, name, args.users, args.concurrency, house_ids, first_user_id)
+            first_user_id += args.users
+            results.append(result)
+            if args.json:
+                print(json.dumps(result, ensure_ascii=False))
+            else:
+                print(
+                    f"{result['scenario']:<14} {result['updates']:>7} обн. {result['seconds']:>8.2f} с "
+                    f"{result['updates_per_second']:>9.1f} обн./с  p50 {result['p50_ms']:>7.2f} мс  "
+                    f"p99 {result['p99_ms']:>7.2f} мс  ошибок {result['errors']}  потеряно {result['dropped']}"
+                )
+    finally:
+        await main.flush_users()
+        main.close_db()
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест обработчиков бота без обращения к Telegram')
+    parser.add_argument('scenarios', nargs='*', help=f"сценарии: {', '.join(SCENARIOS)}, по умолчанию все")
+    parser.add_argument('-u', '--users', type=int, default=200, help='число пользователей в сценарии')
+    parser.add_argument('-c', '--concurrency', type=int, default=20, help='сколько пользователей работают одновременно')
+    parser.add_argument('--api-latency', type=float, default=0, help='задержка ответа Telegram, мс')
+    parser.add_argument('--json', action='store_true', help='результаты строками JSON')
+    parser.add_argument('--rate-limit', action='store_true', help='не снимать ограничение частоты запросов от чата')
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Работаем с копиями баз и файлов во временном каталоге
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    for file_name in ('data.db', 'users.db'):
+        if os.path.exists(os.path.join(source_dir, file_name)):
+            shutil.copy(os.path.join(source_dir, file_name), work_dir)
+    os.chdir(work_dir)
+    sys.path.insert(0, source_dir)
+
+    os.environ.setdefault('TOKEN', '123456:bench')
+    os.environ['FSM_STORAGE'] = os.environ.get('BENCH_FSM_STORAGE', 'memory')
+    os.environ.pop('WEBHOOK_URL', None)
+
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Ненулевой код выхода, если какой-то обработчик упал или обновление не дошло до обработчика
+    failed = any(result['errors'] or (result['dropped'] and not args.rate_limit) for result in results)
+    sys.exit(1 if failed else 0)
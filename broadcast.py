@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import time
+import uuid
+
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+
+from data import data_pool, run_db
+from ratelimit import TokenBucket, KeyedTokenBuckets
+
+
+# Telegram пропускает около 30 сообщений в секунду на бота и одно сообщение в секунду в один чат.
+# Рассылка берет меньше общего лимита, чтобы ответы на обычные нажатия не упирались в него
+GLOBAL_RATE = 20
+PER_CHAT_RATE = 1
+
+# Сколько получателей читаем из базы за раз и сколько сообщений отправляем одновременно
+CHUNK_SIZE = 500
+MAX_IN_FLIGHT = 25
+
+# Сколько раз повторяем отправку после RetryAfter
+MAX_RETRIES = 5
+
+# Рассылку ведет процесс, арендовавший ее строку. Аренда продлевается с каждой сохраненной порцией,
+# рассылку остановленного процесса другие процессы подхватывают после истечения аренды
+LEASE_SECONDS = 300
+RESUME_INTERVAL = 60
+
+
+def _insert_broadcast(text, admin_chat_id, owner):
+    with data_pool.connection() as conn:
+        now = time.time()
+        cursor = conn.execute(
+            'INSERT INTO broadcasts (text, admin_chat_id, started_at, owner, leased_until) VALUES (?, ?, ?, ?, ?)',
+            (text, admin_chat_id, now, owner, now + LEASE_SECONDS)
+        )
+        return cursor.lastrowid
+
+
+def _fetch_broadcast(broadcast_id):
+    with data_pool.connection() as conn:
+        return conn.execute(
+            'SELECT id, text, admin_chat_id, status, last_user_id, sent, blocked, failed, started_at, finished_at FROM broadcasts WHERE id = ?',
+            (broadcast_id,)
+        ).fetchone()
+
+
+def _fetch_last_broadcast():
+    with data_pool.connection() as conn:
+        return conn.execute(
+            'SELECT id, text, admin_chat_id, status, last_user_id, sent, blocked, failed, started_at, finished_at FROM broadcasts ORDER BY id DESC LIMIT 1'
+        ).fetchone()
+
+
+def _fetch_running_broadcasts():
+    with data_pool.connection() as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM broadcasts WHERE status = 'running'")]
+
+
+# Аренда рассылки: True, если строка свободна или аренда другого процесса истекла
+def _claim_broadcast(broadcast_id, owner):
+    with data_pool.connection() as conn:
+        now = time.time()
+        cursor = conn.execute(
+            "UPDATE broadcasts SET owner = ?, leased_until = ? "
+            "WHERE id = ? AND status = 'running' AND (owner IS NULL OR owner = ? OR leased_until < ?)",
+            (owner, now + LEASE_SECONDS, broadcast_id, owner, now)
+        )
+        return cursor.rowcount > 0
+
+
+# Остановленный процесс отдает рассылку, не дожидаясь истечения аренды
+def _release_broadcast(broadcast_id, owner):
+    with data_pool.connection() as conn:
+        conn.execute(
+            'UPDATE broadcasts SET owner = NULL, leased_until = NULL WHERE id = ? AND owner = ?',
+            (broadcast_id, owner)
+        )
+
+
+# Получатели читаются порциями по возрастанию user_id, начиная после последнего обработанного
+def _fetch_recipients(after_user_id, limit):
+    with data_pool.connection() as conn:
+        return conn.execute(
+            'SELECT user_id, chat_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+            (after_user_id, limit)
+        ).fetchall()
+
+
+# Прогресс сохраняется вместе с продлением аренды. False, если рассылку уже ведет другой процесс
+def _save_progress(broadcast_id, owner, last_user_id, sent, blocked, failed):
+    with data_pool.connection() as conn:
+        cursor = conn.execute(
+            'UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, blocked = blocked + ?, failed = failed + ?, '
+            'leased_until = ? WHERE id = ? AND owner = ?',
+            (last_user_id, sent, blocked, failed, time.time() + LEASE_SECONDS, broadcast_id, owner)
+        )
+        return cursor.rowcount > 0
+
+
+def _finish_broadcast(broadcast_id, owner):
+    with data_pool.connection() as conn:
+        conn.execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = ?, owner = NULL, leased_until = NULL WHERE id = ? AND owner = ?",
+            (time.time(), broadcast_id, owner)
+        )
+
+
+def format_report(row):
+    broadcast_id, _, _, status, _, sent, blocked, failed, started_at, finished_at = row
+    elapsed = (finished_at or time.time()) - started_at
+    rate = sent / elapsed if elapsed > 0 else 0
+    status_text = "завершена" if status == 'done' else "идет"
+    return (
+        f"Рассылка #{broadcast_id} {status_text}.\n"
+        f"Доставлено: {sent}\n"
+        f"Заблокировали бота: {blocked}\n"
+        f"Ошибок: {failed}\n"
+        f"Время: {elapsed:.1f} с, скорость: {rate:.1f} сообщ./с"
+    )
+
+
+# Рассылка сообщения всем зарегистрированным пользователям с учетом ограничений Telegram.
+# Прогресс сохраняется после каждой порции, поэтому прерванную рассылку можно продолжить
+class Broadcaster:
+    def __init__(self, bot, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = KeyedTokenBuckets(per_chat_rate)
+        self.tasks = {}
+        # Владелец арендованных этим процессом рассылок
+        self.owner = uuid.uuid4().hex
+
+    async def _send(self, chat_id, text, reply_markup):
+        for _ in range(MAX_RETRIES):
+            await self.chat_buckets.acquire(chat_id)
+            await self.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, reply_markup=reply_markup)
+                return 'sent'
+            except TelegramRetryAfter as e:
+                # Ограничение действует на весь бот: останавливаем все отправки рассылки, а не только эту
+                self.global_bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return 'blocked'
+            except TelegramAPIError as e:
+                logging.warning("Рассылка: не удалось отправить в чат %s: %s", chat_id, e)
+                return 'failed'
+        return 'failed'
+
+    async def _run(self, broadcast_id, reply_markup):
+        row = await run_db(_fetch_broadcast, broadcast_id)
+        text, admin_chat_id, last_user_id = row[1], row[2], row[4]
+        semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+        async def send_limited(chat_id):
+            async with semaphore:
+                return await self._send(chat_id, text, reply_markup)
+
+        while True:
+            recipients = await run_db(_fetch_recipients, last_user_id, CHUNK_SIZE)
+            if not recipients:
+                break
+
+            results = await asyncio.gather(*(send_limited(chat_id) for _, chat_id in recipients))
+            last_user_id = recipients[-1][0]
+            saved = await run_db(
+                _save_progress, broadcast_id, self.owner, last_user_id,
+                results.count('sent'), results.count('blocked'), results.count('failed')
+            )
+            if not saved:
+                logging.warning("Рассылку #%s продолжает другой процесс", broadcast_id)
+                return
+
+        await run_db(_finish_broadcast, broadcast_id, self.owner)
+        report = format_report(await run_db(_fetch_broadcast, broadcast_id))
+        logging.info(report)
+        if admin_chat_id:
+            try:
+                await self.bot.send_message(admin_chat_id, report)
+            except TelegramAPIError:
+                pass
+
+    # Запуск рассылки в фоне, обработка обычных обновлений при этом не блокируется
+    def _start_task(self, broadcast_id, reply_markup):
+        task = asyncio.create_task(self._run(broadcast_id, reply_markup))
+        self.tasks[broadcast_id] = task
+
+        def on_done(task):
+            self.tasks.pop(broadcast_id, None)
+            if not task.cancelled() and task.exception():
+                logging.error("Рассылка #%s прервана", broadcast_id, exc_info=task.exception())
+
+        task.add_done_callback(on_done)
+        return task
+
+    async def start(self, text, admin_chat_id, reply_markup=None):
+        broadcast_id = await run_db(_insert_broadcast, text, admin_chat_id, self.owner)
+        self._start_task(broadcast_id, reply_markup)
+        return broadcast_id
+
+    # Продолжение рассылок, прерванных остановкой бота. Процесс берет только рассылки,
+    # которые смог арендовать, поэтому несколько процессов не отправляют одну рассылку дважды
+    async def resume(self, reply_markup=None):
+        claimed = []
+        for broadcast_id in await run_db(_fetch_running_broadcasts):
+            if broadcast_id not in self.tasks and await run_db(_claim_broadcast, broadcast_id, self.owner):
+                self._start_task(broadcast_id, reply_markup)
+                claimed.append(broadcast_id)
+        return claimed
+
+    # Периодическая проверка рассылок, аренда которых истекла (процесс, который их вел, остановлен)
+    async def watch(self, reply_markup=None, interval=RESUME_INTERVAL):
+        while True:
+            try:
+                await self.resume(reply_markup)
+            except Exception:
+                logging.exception("Ошибка продолжения рассылок")
+            await asyncio.sleep(interval)
+
+    # Остановка бота: прерываем свои рассылки и сразу отдаем их другим процессам
+    async def stop(self):
+        tasks = dict(self.tasks)
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for broadcast_id in tasks:
+            await run_db(_release_broadcast, broadcast_id, self.owner)
+
+    async def last_report(self):
+        row = await run_db(_fetch_last_broadcast)
+        return format_report(row) if row else None
@@ -0,0 +1,106 @@
+import inspect
+
+from aiogram.filters.callback_data import CallbackData
+
+from metrics import handler_seconds
+
+
+# Разделитель полей в данных кнопок (значение по умолчанию в aiogram)
+SEPARATOR = ":"
+
+
+# Данные кнопок. Префикс однозначно определяет обработчик, поля разбираются самим классом.
+# Дом передается числовым id, а не названием, чтобы данные кнопки оставались короткими
+class SendPdf(CallbackData, prefix="pdf"):
+    command: str
+
+
+class House(CallbackData, prefix="house"):
+    house_id: int
+
+
+class Presentation(CallbackData, prefix="presentation"):
+    house_id: int
+
+
+class EditHouse(CallbackData, prefix="edit_house"):
+    house_id: int
+
+
+class EditPresentation(CallbackData, prefix="edit_presentation"):
+    house_id: int
+
+
+class EditLink(CallbackData, prefix="edit_link"):
+    field: str
+    house_id: int
+
+
+class EditRule(CallbackData, prefix="edit_rule"):
+    rule: str
+
+
+class ConfirmDeleteHouse(CallbackData, prefix="delete_house_ok"):
+    house_id: int
+
+
+class ConfirmAddLot(CallbackData, prefix="add_lot_ok"):
+    house_id: int
+
+
+class ConfirmDeleteLot(CallbackData, prefix="delete_lot_ok"):
+    house_id: int
+
+
+class SearchPage(CallbackData, prefix="search_page"):
+    page: int
+
+
+# Листание списков домов: start_id - id первого дома на странице
+class ListPage(CallbackData, prefix="page"):
+    menu: str
+    start_id: int
+
+
+# Маршрутизация нажатий на кнопки: обработчик находится одним поиском по префиксу
+# вместо последовательной проверки фильтров каждого обработчика
+class CallbackRouter:
+    def __init__(self):
+        self.handlers = {}
+
+    # Регистрация обработчика для класса CallbackData или для кнопки с постоянным значением
+    def register(self, callback_data):
+        def decorator(func):
+            if isinstance(callback_data, str):
+                prefix = callback_data
+            else:
+                prefix = callback_data.__prefix__
+
+            if prefix in self.handlers:
+                raise ValueError(f"Обработчик для '{prefix}' уже зарегистрирован")
+
+            params = set(inspect.signature(func).parameters)
+            self.handlers[prefix] = (callback_data, func, params)
+            return func
+        return decorator
+
+    # Возвращает False, если для кнопки нет обработчика или ее данные не разбираются
+    # (например, кнопка осталась в чате от прошлой версии бота)
+    async def dispatch(self, call, **kwargs):
+        prefix = (call.data or '').split(SEPARATOR, 1)[0]
+        handler = self.handlers.get(prefix)
+        if handler is None:
+            return False
+
+        callback_data, func, params = handler
+        args = ()
+        if not isinstance(callback_data, str):
+            try:
+                args = (callback_data.unpack(call.data),)
+            except (TypeError, ValueError):
+                return False
+
+        kwargs = {name: value for name, value in kwargs.items() if name in params}
+        with handler_seconds.time(handler=f"callback:{prefix}"):
+            await func(call, *args, **kwargs)
+        return True
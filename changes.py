@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import os
+
+import data
+from data import data_pool, run_db, bump_version, load_houses_data
+
+
+# Как часто процесс проверяет версии данных в базе, в секундах: кэши других процессов
+# обновляются не позже чем через этот интервал после изменения
+POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "2"))
+
+
+def _fetch_versions():
+    with data_pool.connection() as conn:
+        return dict(conn.execute('SELECT name, version FROM data_versions').fetchall())
+
+
+# Транспорт уведомлений по умолчанию: периодически читает таблицу data_versions.
+# Отдельная публикация не нужна, версии в базе увеличиваются в транзакции изменения.
+# Другой транспорт (например, Redis pub/sub) реализует те же методы: start, publish и listen,
+# который возвращает множества имен изменившихся данных
+class SQLitePollingTransport:
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.versions = {}
+
+    # Запоминаем текущие версии до загрузки кэшей, чтобы не пропустить изменения во время загрузки
+    async def start(self):
+        self.versions = await run_db(_fetch_versions)
+
+    async def publish(self, names):
+        pass
+
+    async def listen(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            versions = await run_db(_fetch_versions)
+            changed = {name for name, version in versions.items() if self.versions.get(name) != version}
+            self.versions = versions
+            if changed:
+                yield changed
+
+
+def create_change_transport():
+    return SQLitePollingTransport()
+
+
+# Перестраиваем кэши процесса после изменений. Свои изменения процесс тоже получает,
+# повторная загрузка каталога в этом случае ничего не меняет
+async def apply_changes(names):
+    names = {name for name in names if name in data.data_versions}
+    if names & {'houses', 'favorites', 'file_ids'}:
+        await load_houses_data()
+    bump_version(*names)
+
+
+async def listen_changes(transport):
+    data.change_transport = transport
+    try:
+        async for names in transport.listen():
+            try:
+                await apply_changes(names)
+            except Exception:
+                logging.exception("Не удалось обновить кэши после изменения %s", ', '.join(sorted(names)))
+    finally:
+        data.change_transport = None
@@ -0,0 +1,659 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import db_query_seconds, cache_hit
+
+
+# Файл базы данных: каталог, лоты, правила, пользователи и рассылки
+DATA_DB = 'data.db'
+
+
+# Пул постоянных соединений с SQLite: соединения открываются один раз, настраиваются
+# под WAL и переиспользуются всеми вызовами вместе с кэшем подготовленных запросов
+class ConnectionPool:
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, cached_statements=256)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA cache_size=-8000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        # Удаление дома каскадом убирает его из лотов
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._connections) < self.size:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+
+        # Все соединения заняты, ждем освобождения
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._idle = queue.LifoQueue()
+
+
+data_pool = ConnectionPool(DATA_DB)
+
+
+def close_db():
+    data_pool.close()
+
+
+# Все обращения к SQLite выполняются в пуле потоков, чтобы не блокировать цикл событий бота
+async def run_db(func, *args):
+    with db_query_seconds.time(query=func.__name__.lstrip('_')):
+        return await asyncio.to_thread(func, *args)
+
+
+# LRU-кэш с ограниченным временем жизни записей
+class TTLCache:
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._items[key]
+            return None
+
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (value, time.monotonic() + self.ttl)
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+
+# Кэш зарегистрированных пользователей: chat_id -> имя
+users_cache = TTLCache()
+
+
+# Счетчики изменений данных: по ним кэши (например, клавиатуры) понимают, что пора перестроиться
+data_versions = {'houses': 0, 'favorites': 0, 'pdf_files': 0, 'file_ids': 0}
+
+
+def bump_version(*names):
+    for name in names:
+        data_versions[name] += 1
+
+
+# Версии тех же данных в базе общие для всех процессов бота и увеличиваются в транзакции изменения.
+# По ним остальные процессы узнают, что их кэши устарели (см. changes.py)
+def _bump_db_versions(cursor, *names):
+    cursor.executemany('UPDATE data_versions SET version = version + 1 WHERE name = ?', [(name,) for name in names])
+
+
+# Аренда фоновой работы, которую должен выполнять один процесс бота (например, проверка файлов).
+# True, если аренда свободна, истекла или уже принадлежит owner; аренда продлевается на seconds секунд
+def _acquire_lease(name, owner, seconds):
+    with data_pool.connection() as conn:
+        now = time.time()
+        cursor = conn.execute(
+            '''INSERT INTO leases (name, owner, leased_until) VALUES (?, ?, ?)
+               ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, leased_until = excluded.leased_until
+               WHERE leases.owner = excluded.owner OR leases.leased_until < ?''',
+            (name, owner, now + seconds, now)
+        )
+        return cursor.rowcount > 0
+
+
+async def acquire_lease(name, owner, seconds):
+    return await run_db(_acquire_lease, name, owner, seconds)
+
+
+# Транспорт уведомлений об изменениях для других процессов, задается при запуске бота
+change_transport = None
+
+
+# Изменение данных этим процессом: кэши процесса перестраиваются сразу, остальные узнают через транспорт
+async def data_changed(*names):
+    bump_version(*names)
+    if change_transport is not None:
+        await change_transport.publish(set(names))
+
+
+# Кэш каталога домов: загружается один раз при старте и обновляется при изменениях
+houses_cache = {}
+houses_cache_loaded = False
+
+# Индекс каталога по id дома: id -> название
+houses_by_id = {}
+
+# Поля дома, которые меняет update_house: поле -> тип значения.
+# Имя поля подставляется в SQL, поэтому другие поля не принимаются
+HOUSE_FIELDS = {
+    'presentation': str,
+    'video': str,
+    'renders': str,
+    'reference': str,
+    'shorts_video': str,
+    'house_sales': str,
+    'dynamics': str,
+    'choose_apartment': str,
+    'recording_presentation': str,
+}
+
+
+def house_row_to_dict(row):
+    return {
+        "presentation": row[1],
+        "video": row[2],
+        "renders": row[3],
+        "reference": row[4],
+        "shorts_video": row[5],
+        "house_sales": row[6],
+        "dynamics": row[7],
+        "choose_apartment": row[8],
+        "recording_presentation": row[9],
+        "presentation_file_id": row[10],
+        "id": row[11],
+        "is_favorite": bool(row[12])
+    }
+
+
+def _fetch_houses():
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Каталог вместе с признаком лота недели одним запросом
+        cursor.execute('''
+            SELECT houses.name, houses.presentation, houses.video, houses.renders, houses.reference,
+                   houses.shorts_video, houses.house_sales, houses.dynamics, houses.choose_apartment, houses.recording_presentation,
+                   houses.presentation_file_id, houses.id, favorite_houses.house_id IS NOT NULL
+            FROM houses
+            LEFT JOIN favorite_houses ON favorite_houses.house_id = houses.id
+        ''')
+        rows = cursor.fetchall()
+        return rows
+
+
+async def load_houses_data():
+    global houses_cache_loaded
+
+    rows = await run_db(_fetch_houses)
+
+    # Преобразуем данные в словарь и заменяем содержимое кэша
+    houses_cache.clear()
+    houses_by_id.clear()
+    for row in rows:
+        houses_cache[row[0]] = house_row_to_dict(row)
+        houses_by_id[row[11]] = row[0]
+    houses_cache_loaded = True
+    bump_version('houses')
+
+
+async def get_houses_data():
+    # Читаем каталог из кэша, к базе обращаемся только при первом вызове
+    if not houses_cache_loaded:
+        await load_houses_data()
+    return houses_cache
+
+
+# Название дома по его id, None если такого дома нет
+async def get_house_by_id(house_id):
+    if not houses_cache_loaded:
+        await load_houses_data()
+    return houses_by_id.get(house_id)
+
+
+def _insert_house(row):
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Выполняем вставку данных в таблицу, дом с занятым названием не добавляется
+        cursor.execute('''
+            INSERT OR IGNORE INTO houses (name, presentation, video, renders, reference, shorts_video, house_sales, dynamics, choose_apartment, recording_presentation)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', row)
+        if cursor.rowcount == 0:
+            return None
+        _bump_db_versions(cursor, 'houses')
+        return cursor.lastrowid
+
+
+async def add_house(house_name, presentation, video, renders, reference, shorts_video, house_sales, dynamics, choose_apartment, recording_presentation):
+    row = (house_name, presentation, video, renders, reference, shorts_video, house_sales, dynamics, choose_apartment, recording_presentation)
+    house_id = await run_db(_insert_house, row)
+    if house_id is None:
+        return None
+
+    # Обновляем кэш каталога
+    if houses_cache_loaded:
+        houses_cache[house_name] = house_row_to_dict(row + (None, house_id, False))
+        houses_by_id[house_id] = house_name
+    await data_changed('houses')
+    return house_id
+
+
+def _delete_house(house_name):
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Удаляем запись, соответствующую имени дома, лот удаляется каскадом
+        cursor.execute('DELETE FROM houses WHERE name = ?', (house_name,))
+        _bump_db_versions(cursor, 'houses', 'favorites')
+
+
+async def delete_house(house_name):
+    await run_db(_delete_house, house_name)
+
+    # Убираем дом из кэша каталога
+    house = houses_cache.pop(house_name, None)
+    if house:
+        houses_by_id.pop(house['id'], None)
+    await data_changed('houses', 'favorites')
+
+
+def _update_house(house_name, field, new_value):
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Обновляем конкретное поле дома
+        query = f'UPDATE houses SET {field} = ? WHERE name = ?'
+        cursor.execute(query, (new_value, house_name))
+
+        # Новый файл презентации делает сохраненный file_id недействительным
+        if field == 'presentation':
+            cursor.execute('UPDATE houses SET presentation_file_id = NULL WHERE name = ?', (house_name,))
+        _bump_db_versions(cursor, 'houses')
+
+
+async def update_house(house_name, field, new_value):
+    if field not in HOUSE_FIELDS:
+        raise ValueError(f"Поле дома {field!r} нельзя изменить")
+    if new_value is not None and not isinstance(new_value, HOUSE_FIELDS[field]):
+        raise ValueError(f"Неверный тип значения для поля {field!r}")
+
+    await run_db(_update_house, house_name, field, new_value)
+
+    # Обновляем поле в кэше каталога
+    if house_name in houses_cache:
+        houses_cache[house_name][field] = new_value
+        if field == 'presentation':
+            houses_cache[house_name]['presentation_file_id'] = None
+    await data_changed('houses')
+
+
+def _set_presentation_file_id(house_name, file_id, presentation):
+    with data_pool.connection() as conn:
+        if presentation is None:
+            cursor = conn.execute('UPDATE houses SET presentation_file_id = ? WHERE name = ?', (file_id, house_name))
+        else:
+            cursor = conn.execute(
+                'UPDATE houses SET presentation_file_id = ? WHERE name = ? AND presentation = ?',
+                (file_id, house_name, presentation)
+            )
+        if cursor.rowcount == 0:
+            return False
+        # file_id презентаций хранится в кэше каталога каждого процесса
+        _bump_db_versions(cursor, 'file_ids')
+        return True
+
+
+# Сохраняем file_id загруженной в Telegram презентации, чтобы не загружать файл повторно.
+# Если передано имя файла presentation, file_id сохраняется, только пока у дома тот же файл:
+# админ мог заменить презентацию, пока старая загружалась
+async def set_presentation_file_id(house_name, file_id, presentation=None):
+    if not await run_db(_set_presentation_file_id, house_name, file_id, presentation):
+        return False
+
+    house = houses_cache.get(house_name)
+    if house is not None and (presentation is None or house['presentation'] == presentation):
+        house['presentation_file_id'] = file_id
+    await data_changed('file_ids')
+    return True
+
+
+def _add_favorite_house(house_name):
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Находим id дома по имени
+        cursor.execute('SELECT id FROM houses WHERE name = ?', (house_name,))
+        house_id = cursor.fetchone()
+
+        if house_id:
+            # Вставляем в таблицу избранных домов, повторное добавление ничего не меняет
+            cursor.execute('INSERT OR IGNORE INTO favorite_houses (house_id) VALUES (?)', (house_id[0],))
+            _bump_db_versions(cursor, 'favorites')
+        else:
+            print(f"Дом с названием '{house_name}' не найден.")
+
+
+async def add_favorite_house(house_name):
+    await run_db(_add_favorite_house, house_name)
+
+    if house_name in houses_cache:
+        houses_cache[house_name]['is_favorite'] = True
+    await data_changed('favorites')
+
+
+def _remove_favorite_house(house_name):
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Находим id дома по имени
+        cursor.execute('SELECT id FROM houses WHERE name = ?', (house_name,))
+        house_id = cursor.fetchone()
+
+        if house_id:
+            # Удаляем дом из таблицы избранных домов
+            cursor.execute('DELETE FROM favorite_houses WHERE house_id = ?', (house_id[0],))
+            _bump_db_versions(cursor, 'favorites')
+        else:
+            print(f"Дом с названием '{house_name}' не найден.")
+
+
+async def remove_favorite_house(house_name):
+    await run_db(_remove_favorite_house, house_name)
+
+    if house_name in houses_cache:
+        houses_cache[house_name]['is_favorite'] = False
+    await data_changed('favorites')
+
+
+# Лоты недели берутся из кэша каталога, признак is_favorite загружается вместе с домами
+async def get_favorite_houses():
+    houses = await get_houses_data()
+    return {name: info for name, info in houses.items() if info['is_favorite']}
+
+
+# Выгрузка каталога в файл: строки читаются из курсора по одной, без загрузки всей таблицы в список.
+# CSV с BOM, чтобы Excel сразу открывал кириллицу
+EXPORT_FORMATS = ('json', 'csv')
+EXPORT_COLUMNS = ('id', 'name') + tuple(HOUSE_FIELDS) + ('is_favorite',)
+
+
+def _export_houses(fmt):
+    buffer = io.StringIO()
+    with data_pool.connection() as conn:
+        cursor = conn.execute(f'''
+            SELECT {', '.join(f'houses.{column}' for column in EXPORT_COLUMNS[:-1])}, favorite_houses.house_id IS NOT NULL
+            FROM houses
+            LEFT JOIN favorite_houses ON favorite_houses.house_id = houses.id
+            ORDER BY houses.id
+        ''')
+
+        if fmt == 'csv':
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_COLUMNS)
+            for row in cursor:
+                writer.writerow(row[:-1] + (int(row[-1]),))
+            return buffer.getvalue().encode('utf-8-sig')
+
+        buffer.write('[')
+        for i, row in enumerate(cursor):
+            buffer.write(',\n' if i else '\n')
+            house = dict(zip(EXPORT_COLUMNS, row))
+            house['is_favorite'] = bool(house['is_favorite'])
+            buffer.write(json.dumps(house, ensure_ascii=False))
+        buffer.write('\n]\n')
+    return buffer.getvalue().encode('utf-8')
+
+
+# Готовые выгрузки: формат -> {'version', 'content', 'file_id'}.
+# Пока каталог и лоты не менялись, повторная выгрузка не обращается к базе,
+# а file_id позволяет переотправить уже загруженный в Telegram файл
+export_cache = {}
+
+
+async def export_houses(fmt):
+    version = (data_versions['houses'], data_versions['favorites'])
+    export = export_cache.get(fmt)
+    cache_hit('export', export is not None and export['version'] == version)
+    if export is None or export['version'] != version:
+        content = await run_db(_export_houses, fmt)
+        export = export_cache[fmt] = {'version': version, 'content': content, 'file_id': None}
+    return export
+
+
+def _fetch_pdf_files():
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Получаем все записи из таблицы pdf_files
+        cursor.execute('SELECT command, filename, file_id FROM pdf_files')
+        pdf_files = cursor.fetchall()
+        return pdf_files
+
+
+async def get_pdf_files():
+    pdf_files = await run_db(_fetch_pdf_files)
+
+    # Преобразуем результат в словарь
+    pdf_map = {row[0]: row[1] for row in pdf_files}
+    return pdf_map
+
+
+# Все документы правил: команда -> (путь к файлу, file_id)
+async def get_pdf_documents():
+    pdf_files = await run_db(_fetch_pdf_files)
+    return {row[0]: (row[1], row[2]) for row in pdf_files}
+
+
+# Возвращает путь к документу и сохраненный file_id для команды
+async def get_pdf_document(command):
+    pdf_files = await run_db(_fetch_pdf_files)
+    for row in pdf_files:
+        if row[0] == command:
+            return row[1], row[2]
+    return None, None
+
+
+def _update_pdf_file(command, new_filename):
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Обновляем запись в таблице по команде
+        cursor.execute('UPDATE pdf_files SET filename = ?, file_id = NULL WHERE command = ?', (new_filename, command))
+        _bump_db_versions(cursor, 'pdf_files')
+
+
+async def update_pdf_file(command, new_filename):
+    await run_db(_update_pdf_file, command, new_filename)
+    await data_changed('pdf_files')
+
+
+def _set_pdf_file_id(command, file_id, filename):
+    with data_pool.connection() as conn:
+        if filename is None:
+            cursor = conn.execute('UPDATE pdf_files SET file_id = ? WHERE command = ?', (file_id, command))
+        else:
+            cursor = conn.execute(
+                'UPDATE pdf_files SET file_id = ? WHERE command = ? AND filename = ?',
+                (file_id, command, filename)
+            )
+        return cursor.rowcount > 0
+
+
+# Как и для презентаций, с filename file_id сохраняется только для того же файла правил
+async def set_pdf_file_id(command, file_id, filename=None):
+    return await run_db(_set_pdf_file_id, command, file_id, filename)
+
+
+def _upsert_users(rows):
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Все накопленные регистрации записываются одной транзакцией.
+        # Повторная регистрация пользователя обновляет его данные
+        cursor.executemany(
+            """INSERT INTO users (user_id, chat_id, phone_number, first_name, last_name, company, email)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(user_id) DO UPDATE SET
+                   chat_id = excluded.chat_id,
+                   phone_number = excluded.phone_number,
+                   first_name = excluded.first_name,
+                   last_name = excluded.last_name,
+                   company = excluded.company,
+                   email = excluded.email""",
+            rows
+        )
+
+
+# Сколько регистраций копим перед записью и сколько секунд запись может ждать
+USERS_BATCH_SIZE = 100
+USERS_FLUSH_INTERVAL = 1.0
+
+
+# Отложенная запись регистраций: строки копятся в памяти и пишутся пачкой,
+# когда их набралось USERS_BATCH_SIZE или прошло USERS_FLUSH_INTERVAL секунд
+class UserWriteQueue:
+    def __init__(self, batch_size=USERS_BATCH_SIZE, flush_interval=USERS_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # user_id -> строка таблицы users, повторная регистрация заменяет предыдущую
+        self.pending = {}
+        self._lock = asyncio.Lock()
+        self._timer = None
+        self._tasks = set()
+
+    async def put(self, row):
+        self.pending[row[0]] = row
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._flush_in_background)
+
+    def _flush_in_background(self):
+        self._timer = None
+        task = asyncio.create_task(self._background_flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _background_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            # Строки остались в очереди, повторяем запись через flush_interval
+            logging.exception("Не удалось записать %s регистраций", len(self.pending))
+            if self.pending:
+                self._schedule_flush()
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        async with self._lock:
+            if not self.pending:
+                return
+            rows = list(self.pending.values())
+            self.pending = {}
+            try:
+                await run_db(_upsert_users, rows)
+            except Exception:
+                # Возвращаем строки в очередь, если пользователь не успел зарегистрироваться заново
+                for row in rows:
+                    self.pending.setdefault(row[0], row)
+                raise
+
+    # Имя пользователя из еще не записанной регистрации
+    def pending_first_name(self, chat_id):
+        for row in self.pending.values():
+            if row[1] == chat_id:
+                return row[3]
+        return None
+
+
+users_queue = UserWriteQueue()
+
+
+# Сохранение данных пользователя в SQLite
+async def save_user_data(user_data, message):
+    row = (message.from_user.id, message.chat.id, user_data['phone'], user_data['first_name'], user_data['last_name'], user_data['company'], user_data['email'])
+    users_cache.set(message.chat.id, user_data['first_name'])
+    await users_queue.put(row)
+
+
+# Запись всех накопленных регистраций, вызывается при остановке бота
+async def flush_users():
+    await users_queue.flush()
+
+
+def _fetch_user(chat_id):
+    with data_pool.connection() as conn:
+        cursor = conn.cursor()
+
+        # Проверяем, есть ли пользователь в базе данных
+        cursor.execute("SELECT first_name FROM users WHERE chat_id = ?", (chat_id,))
+        user = cursor.fetchone()
+        return user
+
+
+async def check_user(chat_id):
+    # Повторный /start обслуживается из кэша без обращения к базе
+    first_name = users_cache.get(chat_id)
+    cache_hit('users', bool(first_name))
+    if first_name:
+        return first_name
+
+    first_name = users_queue.pending_first_name(chat_id)
+    if first_name:
+        return first_name
+
+    user = await run_db(_fetch_user, chat_id)
+    if user:
+        users_cache.set(chat_id, user[0])
+        return user[0]
+    else:
+        return False
@@ -0,0 +1,337 @@
+from bisect import bisect_left
+
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from callbacks import (
+    SendPdf, House, Presentation, EditHouse, EditPresentation, EditLink, EditRule, ConfirmDeleteHouse,
+    ConfirmAddLot, ConfirmDeleteLot, SearchPage, ListPage
+)
+from data import data_versions, get_houses_data, get_house_by_id, get_favorite_houses, get_pdf_files, TTLCache
+from metrics import cache_hit
+
+
+extra_dict = {
+    "send_pdf_reglament": "Регламент",
+    "send_pdf_contract": "Агентский договор",
+    "send_pdf_ad_rules": "Правила рекламы",
+    "send_pdf_photo_video_rules": "Правила фото и видео"
+}
+
+# Ссылки в карточке дома: текст кнопки и поле дома
+HOUSE_LINKS = [
+    ("Видео о проекте", 'video'),
+    ("Рендеры", 'renders'),
+    ("Эталонные тексты", 'reference'),
+    ("Видео для stories", 'shorts_video'),
+    ("Дом продаж", 'house_sales'),
+    ("Динамика строительства", 'dynamics'),
+    ("Выбрать квартиру", 'choose_apartment'),
+    ("Запись на презентацию", 'recording_presentation'),
+]
+
+# Сколько результатов поиска показываем на одной странице
+SEARCH_PAGE_SIZE = 8
+
+# Сколько домов показываем на одной странице списка
+PAGE_SIZE = 10
+
+# Готовые клавиатуры: (имя, аргументы) -> (версии данных, клавиатура).
+# Аргументы приходят из данных кнопок, поэтому размер кэша ограничен, редко нужные клавиатуры вытесняются
+KEYBOARDS_CACHE_SIZE = 2000
+keyboards_cache = TTLCache(maxsize=KEYBOARDS_CACHE_SIZE, ttl=24 * 3600)
+
+
+# Клавиатура строится один раз и перестраивается, только когда меняются данные, от которых она зависит
+def cached_keyboard(*depends_on):
+    def decorator(func):
+        async def wrapper(*args):
+            key = (func.__name__,) + args
+            version = tuple(data_versions[name] for name in depends_on)
+
+            cached = keyboards_cache.get(key)
+            hit = bool(cached) and cached[0] == version
+            cache_hit('keyboards', hit)
+            if hit:
+                return cached[1]
+
+            keyboard = await func(*args)
+            keyboards_cache.set(key, (version, keyboard))
+            return keyboard
+        return wrapper
+    return decorator
+
+
+# Главное меню
+@cached_keyboard()
+async def main_menu():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="Правила работы", callback_data="rules")
+    builder.button(text="Дома в продаже", callback_data="houses_for_sale")
+    builder.button(text="Лот недели", callback_data="lot_of_the_week")
+    builder.button(text="Проверить на уникальность", url="https://tavrida-development.ru/business/partner/uniqueness/")
+    builder.button(text="Записать на презентацию", url="https://tavrida-development.ru/business/partner/presentation/")
+    builder.button(text="Позвонить", callback_data="call_us")
+    builder.button(text="Брокер-тур", callback_data="broker_tour")
+
+    builder.adjust(1)
+
+    return builder.as_markup()
+
+
+# Кнопки "НАЗАД" и "ГЛАВНОЕ МЕНЮ" после действий админа
+@cached_keyboard()
+async def back_menu(back_callback):
+    builder = InlineKeyboardBuilder()
+    builder.button(text="НАЗАД", callback_data=back_callback)
+    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@cached_keyboard()
+async def main_menu_button():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@cached_keyboard()
+async def check_menu():
+    builder = InlineKeyboardBuilder()
+
+    builder.button(text="Проверить на уникальность", url="https://tavrida-development.ru/business/partner/uniqueness/")
+    builder.button(text="Записать на презентацию", url="https://tavrida-development.ru/business/partner/presentation/")
+
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@cached_keyboard()
+async def rules_menu():
+    builder = InlineKeyboardBuilder()
+    builder.button(text="Регламент", callback_data=SendPdf(command="send_pdf_reglament").pack())
+    builder.button(text="Агентский договор", callback_data=SendPdf(command="send_pdf_contract").pack())
+    builder.button(text="Правила рекламы", callback_data=SendPdf(command="send_pdf_ad_rules").pack())
+    builder.button(text="Правила фото и видео", callback_data=SendPdf(command="send_pdf_photo_video_rules").pack())
+    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
+
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+# Страница списка домов без OFFSET: дома упорядочены по id, страница начинается с первого id не меньше start_id.
+# Добавление и удаление домов не сдвигает уже открытые страницы.
+# houses - словарь название -> данные дома, возвращает дома страницы и кнопки листания
+def houses_page(houses, menu, start_id):
+    ordered = sorted((info['id'], house) for house, info in houses.items())
+    ids = [house_id for house_id, _ in ordered]
+    index = bisect_left(ids, start_id)
+
+    navigation = []
+    if index > 0:
+        navigation.append(InlineKeyboardButton(
+            text="◀️", callback_data=ListPage(menu=menu, start_id=ids[max(0, index - PAGE_SIZE)]).pack()
+        ))
+    if index + PAGE_SIZE < len(ids):
+        navigation.append(InlineKeyboardButton(
+            text="▶️", callback_data=ListPage(menu=menu, start_id=ids[index + PAGE_SIZE]).pack()
+        ))
+    return ordered[index:index + PAGE_SIZE], navigation
+
+
+# Начало страницы из данных кнопки приводится к id существующего дома (или 0 для первой страницы),
+# чтобы произвольные числа из подделанных кнопок не создавали новые записи в кэше клавиатур
+async def page_start(start_id):
+    ids = sorted(info['id'] for info in (await get_houses_data()).values())
+    index = bisect_left(ids, start_id)
+    if index == 0 or not ids:
+        return 0
+    return ids[min(index, len(ids) - 1)]
+
+
+# Дома в продаже
+@cached_keyboard('houses')
+async def houses_menu(start_id=0):
+    builder = InlineKeyboardBuilder()
+    houses = await get_houses_data()
+    page, navigation = houses_page(houses, "houses", start_id)
+    for house_id, house in page:
+        builder.row(InlineKeyboardButton(text=house, callback_data=House(house_id=house_id).pack()))
+    if navigation:
+        builder.row(*navigation)
+
+    builder.row(InlineKeyboardButton(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu"))
+    return builder.as_markup()
+
+
+# Лот недели: возвращает признак наличия лотов и клавиатуру
+@cached_keyboard('houses', 'favorites')
+async def lots_menu(start_id=0):
+    builder = InlineKeyboardBuilder()
+    lots = await get_favorite_houses()
+    page, navigation = houses_page(lots, "lots", start_id)
+    for house_id, house in page:
+        builder.row(InlineKeyboardButton(text=house, callback_data=House(house_id=house_id).pack()))
+    if navigation:
+        builder.row(*navigation)
+
+    builder.row(InlineKeyboardButton(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu"))
+    return bool(lots), builder.as_markup()
+
+
+# Карточка дома, None если такого дома нет
+@cached_keyboard('houses')
+async def house_card(house_id):
+    house = await get_house_by_id(house_id)
+    if house is None:
+        return None
+
+    houses = await get_houses_data()
+    info = houses[house]
+
+    builder = InlineKeyboardBuilder()
+
+    if info['presentation']:
+        builder.row(InlineKeyboardButton(text="Презентация", callback_data=Presentation(house_id=house_id).pack()))
+
+    for text, field in HOUSE_LINKS:
+        if info[field]:
+            builder.row(InlineKeyboardButton(text=text, url=info[field]))
+
+    builder.row(
+        InlineKeyboardButton(text="НАЗАД", callback_data="houses_for_sale"),
+        InlineKeyboardButton(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu"),
+    )
+    return builder.as_markup()
+
+
+# Страница результатов поиска: results - список (id дома, название) от лучшего совпадения к худшему
+async def search_results_menu(results, page):
+    builder = InlineKeyboardBuilder()
+    start = page * SEARCH_PAGE_SIZE
+    for house_id, house in results[start:start + SEARCH_PAGE_SIZE]:
+        builder.row(InlineKeyboardButton(text=house, callback_data=House(house_id=house_id).pack()))
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="◀️", callback_data=SearchPage(page=page - 1).pack()))
+    if start + SEARCH_PAGE_SIZE < len(results):
+        navigation.append(InlineKeyboardButton(text="▶️", callback_data=SearchPage(page=page + 1).pack()))
+    if navigation:
+        builder.row(*navigation)
+
+    builder.row(InlineKeyboardButton(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu"))
+    return builder.as_markup()
+
+
+# Редактирование конкретного дома
+@cached_keyboard()
+async def edit_house_menu(house_id):
+    builder = InlineKeyboardBuilder()
+
+    builder.button(text="Изменить Презентацию", callback_data=EditPresentation(house_id=house_id).pack())
+    builder.button(text="Изменить Видео", callback_data=EditLink(field="video", house_id=house_id).pack())
+    builder.button(text="Изменить Рендоры", callback_data=EditLink(field="renders", house_id=house_id).pack())
+    builder.button(text="Изменить Эталонные текста", callback_data=EditLink(field="reference", house_id=house_id).pack())
+    builder.button(text="Изменить Видео для stories", callback_data=EditLink(field="shorts_video", house_id=house_id).pack())
+    builder.button(text="Изменить Дом продаж", callback_data=EditLink(field="house_sales", house_id=house_id).pack())
+    builder.button(text="Изменить Динамику", callback_data=EditLink(field="dynamics", house_id=house_id).pack())
+    builder.button(text="Изменить Выбрать квартиру", callback_data=EditLink(field="choose_apartment", house_id=house_id).pack())
+    builder.button(text="Изменить Запись на презу", callback_data=EditLink(field="recording_presentation", house_id=house_id).pack())
+
+    builder.button(text="НАЗАД", callback_data="edit_homes")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@cached_keyboard('houses')
+async def edit_homes_menu(start_id=0):
+    builder = InlineKeyboardBuilder()
+
+    houses = await get_houses_data()
+    page, navigation = houses_page(houses, "edit_homes", start_id)
+    for house_id, house in page:
+        builder.row(InlineKeyboardButton(text=f"Редактировать {house}", callback_data=EditHouse(house_id=house_id).pack()))
+    if navigation:
+        builder.row(*navigation)
+
+    builder.row(InlineKeyboardButton(text="Добавить новый дом", callback_data="add_house"))
+    builder.row(InlineKeyboardButton(text="Удалить существующий дом", callback_data="delete_house"))
+
+    builder.row(InlineKeyboardButton(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu"))
+    return builder.as_markup()
+
+
+@cached_keyboard('houses')
+async def delete_house_menu(start_id=0):
+    builder = InlineKeyboardBuilder()
+    houses = await get_houses_data()
+    page, navigation = houses_page(houses, "delete_house", start_id)
+    for house_id, house in page:
+        builder.row(InlineKeyboardButton(text=f"Удалить {house}", callback_data=ConfirmDeleteHouse(house_id=house_id).pack()))
+    if navigation:
+        builder.row(*navigation)
+
+    builder.row(InlineKeyboardButton(text="НАЗАД", callback_data="edit_homes"))
+    return builder.as_markup()
+
+
+@cached_keyboard()
+async def edit_lots_menu():
+    builder = InlineKeyboardBuilder()
+
+    builder.button(text="Добавить новый лот", callback_data="add_lot")
+    builder.button(text="Удалить существующий лот", callback_data="delete_lot")
+
+    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
+
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@cached_keyboard('houses', 'favorites')
+async def delete_lot_menu(start_id=0):
+    builder = InlineKeyboardBuilder()
+    lots = await get_favorite_houses()
+    page, navigation = houses_page(lots, "delete_lot", start_id)
+    for house_id, house in page:
+        builder.row(InlineKeyboardButton(text=f"Удалить {house} из лота", callback_data=ConfirmDeleteLot(house_id=house_id).pack()))
+    if navigation:
+        builder.row(*navigation)
+
+    builder.row(InlineKeyboardButton(text="НАЗАД", callback_data="edit_lots"))
+    return builder.as_markup()
+
+
+# Дома, которые еще можно добавить в лоты: возвращает признак наличия таких домов и клавиатуру
+@cached_keyboard('houses', 'favorites')
+async def add_lot_menu(start_id=0):
+    builder = InlineKeyboardBuilder()
+    lots = await get_favorite_houses()
+    houses = await get_houses_data()
+    candidates = {house: info for house, info in houses.items() if house not in lots}
+    page, navigation = houses_page(candidates, "add_lot", start_id)
+    for house_id, house in page:
+        builder.row(InlineKeyboardButton(text=f"Добавить {house} в лоты", callback_data=ConfirmAddLot(house_id=house_id).pack()))
+    if navigation:
+        builder.row(*navigation)
+
+    builder.row(InlineKeyboardButton(text="НАЗАД", callback_data="edit_lots"))
+    return bool(candidates), builder.as_markup()
+
+
+@cached_keyboard('pdf_files')
+async def edit_rules_menu():
+    builder = InlineKeyboardBuilder()
+
+    rules = await get_pdf_files()
+
+    for rule in rules:
+        builder.button(text=f"Редактировать {extra_dict[rule]}", callback_data=EditRule(rule=rule).pack())
+
+    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
+
+    builder.adjust(1)
+    return builder.as_markup()
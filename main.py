@@ -1,206 +1,117 @@
+import asyncio
 import logging
 import os
+import signal
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ContentType
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, ContentType
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram import Router
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.types.callback_query import CallbackQuery
-from aiogram.types import InputFile, BufferedInputFile
-import sqlite3
+from aiogram.types import InputFile, BufferedInputFile, InlineQueryResultArticle, InputTextMessageContent
 from aiogram.types.input_file import FSInputFile
+from data import (
+    load_houses_data, get_houses_data, add_house, delete_house, update_house,
+    add_favorite_house, remove_favorite_house, update_pdf_file, HOUSE_FIELDS, EXPORT_FORMATS, export_houses,
+    save_user_data, check_user, flush_users, close_db, set_presentation_file_id, get_pdf_document, set_pdf_file_id, get_house_by_id
+)
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from storage import create_storage, create_events_isolation
+from migrations import migrate
+from broadcast import Broadcaster
+from uploads import start_upload, safe_file_name, upload_tasks
+from assets import AssetScanner, is_available, presentation_path
+from changes import create_change_transport, listen_changes
+from middlewares import (
+    ThrottlingMiddleware, UpdateMetricsMiddleware, HandlerMetricsMiddleware, TelegramMetricsMiddleware,
+    ConcurrencyLimitMiddleware, InFlightMiddleware
+)
+from metrics import cache_hit, transfer_bytes_total, start_metrics_server, log_metrics
+from callbacks import (
+    CallbackRouter, SendPdf, House, Presentation, EditHouse, EditPresentation, EditLink, EditRule,
+    ConfirmDeleteHouse, ConfirmAddLot, ConfirmDeleteLot, SearchPage, ListPage
+)
+from keyboards import (
+    extra_dict, main_menu, back_menu, main_menu_button, check_menu, rules_menu, houses_menu, lots_menu,
+    house_card, edit_house_menu, edit_homes_menu, delete_house_menu, edit_lots_menu, delete_lot_menu,
+    add_lot_menu, edit_rules_menu, search_results_menu, page_start, HOUSE_LINKS
+)
+from search import search_houses
 
+# Логирование
+logging.basicConfig(level=logging.INFO)
 
-def get_houses_data():
-    # Подключаемся к базе данных
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
-
-    # Выполняем запрос для получения всех данных
-    cursor.execute("SELECT name, presentation, video, renders, reference, shorts_video, house_sales, dynamics, choose_apartment, recording_presentation FROM houses")
-    rows = cursor.fetchall()
-
-    # Закрываем соединение с базой данных
-    conn.close()
-
-    # Преобразуем данные в словарь
-    houses = {}
-    for row in rows:
-        house_name = row[0]
-        houses[house_name] = {
-            "presentation": row[1],
-            "video": row[2],
-            "renders": row[3],
-            "reference": row[4],
-            "shorts_video": row[5],
-            "house_sales": row[6],
-            "dynamics": row[7],
-            "choose_apartment": row[8],
-            "recording_presentation": row[9]
-        }
-
-    return houses
-
-
-def add_house(house_name, presentation, video, renders, reference, shorts_video, house_sales, dynamics, choose_apartment, recording_presentation):
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
-
-    # Выполняем вставку данных в таблицу
-    cursor.execute('''
-        INSERT INTO houses (name, presentation, video, renders, reference, shorts_video, house_sales, dynamics, choose_apartment, recording_presentation)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (house_name, presentation, video, renders, reference, shorts_video, house_sales, dynamics, choose_apartment, recording_presentation))
-
-    # Сохраняем изменения
-    conn.commit()
-    conn.close()
-
-
-def delete_house(house_name):
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
-
-    # Удаляем запись, соответствующую имени дома
-    cursor.execute('DELETE FROM houses WHERE name = ?', (house_name,))
-
-    # Сохраняем изменения
-    conn.commit()
-    conn.close()
-
-
-def update_house(house_name, field, new_value):
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
-
-    # Обновляем конкретное поле дома
-    query = f'UPDATE houses SET {field} = ? WHERE name = ?'
-    cursor.execute(query, (new_value, house_name))
+# Инициализация бота и диспетчера
+load_dotenv()
+TOKEN = os.getenv("TOKEN")
 
-    # Сохраняем изменения
-    conn.commit()
-    conn.close()
+# Настройки webhook: если WEBHOOK_URL не задан, бот работает через long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
 
+# Адрес Bot API: можно указать локальный Bot API сервер или тестовую заглушку Telegram
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 
-def add_favorite_house(house_name):
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
+# Сколько обновлений обрабатывается одновременно. Обновления одного чата всегда идут по очереди
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "100"))
 
-    # Находим id дома по имени
-    cursor.execute('SELECT id FROM houses WHERE name = ?', (house_name,))
-    house_id = cursor.fetchone()
+# Метрики в формате Prometheus: сервер поднимается, только если задан METRICS_PORT.
+# METRICS_LOG_INTERVAL - как часто (в секундах) писать все метрики в лог строкой JSON, 0 - не писать
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "0"))
 
-    if house_id:
-        # Вставляем в таблицу избранных домов
-        cursor.execute('INSERT INTO favorite_houses (house_id) VALUES (?)', (house_id[0],))
-        conn.commit()
-    else:
-        print(f"Дом с названием '{house_name}' не найден.")
+# Сколько секунд при остановке ждем обработки уже полученных обновлений и загрузок
+SHUTDOWN_TIMEOUT = int(os.getenv("SHUTDOWN_TIMEOUT", "30"))
 
-    conn.close()
+# Служебный чат (например, закрытый канал с ботом), куда заранее загружаются документы без file_id
+ASSET_CHAT_ID = os.getenv("ASSET_CHAT_ID")
 
+# Chat id админов через запятую, только им доступна рассылка
+ADMIN_IDS = {int(chat_id) for chat_id in os.getenv("ADMIN_IDS", "").split(",") if chat_id.strip()}
 
-def remove_favorite_house(house_name):
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
+router = Router()
+callbacks = CallbackRouter()
 
-    # Находим id дома по имени
-    cursor.execute('SELECT id FROM houses WHERE name = ?', (house_name,))
-    house_id = cursor.fetchone()
 
-    if house_id:
-        # Удаляем дом из таблицы избранных домов
-        cursor.execute('DELETE FROM favorite_houses WHERE house_id = ?', (house_id[0],))
-        conn.commit()
+# Бот и диспетчер создаются при запуске, а не при импорте модуля
+def create_bot():
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
     else:
-        print(f"Дом с названием '{house_name}' не найден.")
-
-    conn.close()
-
-
-def get_favorite_houses():
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
-
-    # Получаем информацию о всех избранных домах
-    cursor.execute('''
-        SELECT houses.name, houses.presentation, houses.video, houses.renders, houses.reference,
-               houses.shorts_video, houses.house_sales, houses.dynamics, houses.choose_apartment, houses.recording_presentation
-        FROM houses
-        INNER JOIN favorite_houses ON houses.id = favorite_houses.house_id
-    ''')
-
-    favorite_houses = cursor.fetchall()
-    conn.close()
-
-    # Преобразуем результат в удобный формат словаря
-    favorite_houses_dict = {}
-    for house in favorite_houses:
-        house_name = house[0]
-        favorite_houses_dict[house_name] = {
-            "presentation": house[1],
-            "video": house[2],
-            "renders": house[3],
-            "reference": house[4],
-            "shorts_video": house[5],
-            "house_sales": house[6],
-            "dynamics": house[7],
-            "choose_apartment": house[8],
-            "recording_presentation": house[9]
-        }
-
-    return favorite_houses_dict
-
-
-def get_pdf_files():
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
-
-    # Получаем все записи из таблицы pdf_files
-    cursor.execute('SELECT command, filename FROM pdf_files')
-    pdf_files = cursor.fetchall()
-
-    conn.close()
-
-    # Преобразуем результат в словарь
-    pdf_map = {row[0]: row[1] for row in pdf_files}
-    print(pdf_map)
-    return pdf_map
-
-
-def update_pdf_file(command, new_filename):
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
-
-    # Обновляем запись в таблице по команде
-    cursor.execute('UPDATE pdf_files SET filename = ? WHERE command = ?', (new_filename, command))
-
-    # Сохраняем изменения
-    conn.commit()
-    conn.close()
-
-
-extra_dict = {
-    "send_pdf_reglament": "Регламент",
-    "send_pdf_contract": "Агентский договор",
-    "send_pdf_ad_rules": "Правила рекламы",
-    "send_pdf_photo_video_rules": "Правила фото и видео"
-}
+        session = AiohttpSession()
+    session.middleware(TelegramMetricsMiddleware())
+    return Bot(token=TOKEN, session=session)
+
+
+def create_dispatcher(bot):
+    storage = create_storage()
+    # Middleware FSM подключаем сами, чтобы счетчик обновлений в работе стоял перед блокировкой FSM
+    dp = Dispatcher(storage=storage, events_isolation=create_events_isolation(storage), disable_fsm=True)
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp["in_flight"] = InFlightMiddleware()
+    dp.update.outer_middleware(dp["in_flight"])
+    dp.update.outer_middleware(dp.fsm)
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(UPDATE_CONCURRENCY))
+    dp.include_router(router)
 
-# Логирование
-logging.basicConfig(level=logging.INFO)
+    # Объекты из dp[...] обработчики получают аргументами с тем же именем
+    dp["broadcaster"] = Broadcaster(bot)
+    return dp
 
-# Инициализация бота и диспетчера
-load_dotenv()
-TOKEN = os.getenv("TOKEN")
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
-router = Router()
+# Защита от флуда: общий лимит на чат и отдельный для кнопок, отправляющих файлы
+throttling = ThrottlingMiddleware(heavy_prefixes=(SendPdf.__prefix__, Presentation.__prefix__))
+router.message.outer_middleware(throttling)
+router.callback_query.outer_middleware(throttling)
+router.message.middleware(HandlerMetricsMiddleware())
 
 # Состояния для регистрации
 class Registration(StatesGroup):
@@ -210,53 +121,6 @@ class Registration(StatesGroup):
     company = State()
     email = State()
 
-# Инициализация подключения к SQLite
-async def create_db():
-    conn = sqlite3.connect('users.db')  # Локальная база данных users.db
-    cursor = conn.cursor()
-    # Создаем таблицу, если её нет
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                        user_id INTEGER PRIMARY KEY,
-                        chat_id INTEGER,
-                        phone_number TEXT,
-                        first_name TEXT,
-                        last_name TEXT,
-                        company TEXT,
-                        email TEXT)''')
-    conn.commit()
-    conn.close()
-
-# Сохранение данных пользователя в SQLite
-async def save_user_data(user_data, message):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-
-    # Вставка данных
-    cursor.execute(
-        "INSERT INTO users (user_id, chat_id, phone_number, first_name, last_name, company, email) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (message.from_user.id, message.chat.id, user_data['phone'], user_data['first_name'], user_data['last_name'], user_data['company'], user_data['email'])
-    )
-    conn.commit()
-    conn.close()
-
-
-
-# Инициализация подключения к SQLite
-async def check_user(chat_id):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-
-    # Проверяем, есть ли пользователь в базе данных
-    cursor.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
-    user = cursor.fetchone()
-    if user:
-        return user[3]
-    else:
-        return False
-
-    conn.close()
-
-
 # Команда /start и начало регистрации
 @router.message(Command(commands=['start']))
 async def start_command(message: types.Message, state: FSMContext):
@@ -310,81 +174,79 @@ async def process_email(message: types.Message, state: FSMContext):
     await save_user_data(user_data, message)
 
     await state.clear()
-    await message.answer("Регистрация завершена! Теперь вам доступно главное меню.", reply_markup=main_menu())
-
-# Главное меню
-def main_menu():
-    builder = InlineKeyboardBuilder()
-    builder.button(text="Правила работы", callback_data="rules")
-    builder.button(text="Дома в продаже", callback_data="houses_for_sale")
-    builder.button(text="Лот недели", callback_data="lot_of_the_week")
-    builder.button(text="Проверить на уникальность", url="https://tavrida-development.ru/business/partner/uniqueness/")
-    builder.button(text="Записать на презентацию", url="https://tavrida-development.ru/business/partner/presentation/")
-    builder.button(text="Позвонить", callback_data="call_us")
-    builder.button(text="Брокер-тур", callback_data="broker_tour")
-
-    builder.adjust(1)
+    await message.answer("Регистрация завершена! Теперь вам доступно главное меню.", reply_markup=await main_menu())
+
+# Отправка документа по сохраненному file_id, файл загружается в Telegram только если file_id нет
+# Возвращает новый file_id, если файл пришлось загрузить
+async def answer_document_cached(message: types.Message, file_path, file_id):
+    cache_hit('file_id', bool(file_id))
+    if file_id:
+        try:
+            await message.answer_document(file_id)
+            return None
+        except TelegramBadRequest:
+            # file_id больше не действителен, загружаем файл заново
+            pass
+
+    # Наличие файла известно из фоновой проверки, к диску здесь не обращаемся
+    if not is_available(file_path):
+        logging.warning("Документ %s не найден", file_path)
+        await message.answer("Документ временно недоступен, попробуйте позже.")
+        return None
+
+    sent = await message.answer_document(FSInputFile(file_path))
+    transfer_bytes_total.inc(sent.document.file_size or 0, direction='upload')
+    return sent.document.file_id
+
+
+# Показ экрана. target - сообщение или нажатие на кнопку: при нажатии меняем текст и кнопки
+# текущего сообщения, при команде отправляем новое сообщение
+async def render(target, text, reply_markup=None):
+    if isinstance(target, CallbackQuery):
+        try:
+            await target.message.edit_text(text, reply_markup=reply_markup)
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" in e.message:
+                return
+            # Сообщение нельзя отредактировать (например, это документ), отправляем новое
+        await target.message.answer(text, reply_markup=reply_markup)
+    else:
+        await target.answer(text, reply_markup=reply_markup)
 
-    return builder.as_markup()
 
 # Возвращаем PDF при нажатии кнопок
-@router.callback_query(lambda call: call.data.startswith("send_pdf_"))
-async def send_pdf(call: types.CallbackQuery):
-    pdf_map = get_pdf_files()
-    pdf_file = pdf_map.get(call.data)
+@callbacks.register(SendPdf)
+async def send_pdf(call: types.CallbackQuery, callback_data: SendPdf):
+    pdf_file, file_id = await get_pdf_document(callback_data.command)
     if pdf_file:
-        await call.message.answer_document(FSInputFile(pdf_file))
+        new_file_id = await answer_document_cached(call.message, pdf_file, file_id)
+        if new_file_id:
+            await set_pdf_file_id(callback_data.command, new_file_id, filename=pdf_file)
 
 
 # Возвращаем PDF при нажатии кнопок
-@router.callback_query(lambda call: call.data.startswith("presentation@"))
-async def send_presentation(call: types.CallbackQuery):
-    houses = get_houses_data()
-    house = call.data.split('@')[1]
-    pdf_file = f"{house}/{houses[house]['presentation']}" 
-    if pdf_file:
-        file_path = f'./{pdf_file}'
-        await call.message.answer_document(FSInputFile(file_path))
-
-@router.callback_query(lambda call: call.data.startswith("house_"))
-async def show_house(call: types.CallbackQuery):
-    houses = get_houses_data()
-    house = call.data.split('_')[1]
-    builder = InlineKeyboardBuilder()
-
-    if houses[house]['presentation']:
-        builder.row(InlineKeyboardButton(text="Презентация", callback_data=f"presentation@{house}"))
-    
-    if houses[house]['video']:
-        builder.row(InlineKeyboardButton(text="Видео о проекте", url=houses[house]['video']))
-
-    if houses[house]['renders']:
-        builder.row(InlineKeyboardButton(text="Рендеры", url=houses[house]['renders']))
-
-    if houses[house]['reference']:
-        builder.row(InlineKeyboardButton(text="Эталонные тексты", url=houses[house]['reference']))
-
-    if houses[house]['shorts_video']:
-        builder.row(InlineKeyboardButton(text="Видео для stories", url=houses[house]['shorts_video']))
-
-    if houses[house]['house_sales']:
-        builder.row(InlineKeyboardButton(text="Дом продаж", url=houses[house]['house_sales']))
-
-    if houses[house]['dynamics']:
-        builder.row(InlineKeyboardButton(text="Динамика строительства", url=houses[house]['dynamics']))
-
-    if houses[house]['choose_apartment']:
-        builder.row(InlineKeyboardButton(text="Выбрать квартиру", url=houses[house]['choose_apartment']))
-
-    if houses[house]['recording_presentation']:
-        builder.row(InlineKeyboardButton(text="Запись на презентацию", url=houses[house]['recording_presentation']))
-
-    builder.row(
-        InlineKeyboardButton(text="НАЗАД", callback_data="houses_for_sale"),
-        InlineKeyboardButton(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu"),
-    )
-    
-    await call.message.answer(f'Информация о проекте {house}', reply_markup=builder.as_markup())
+@callbacks.register(Presentation)
+async def send_presentation(call: types.CallbackQuery, callback_data: Presentation):
+    houses = await get_houses_data()
+    house = await get_house_by_id(callback_data.house_id)
+    if house is None:
+        return
+    presentation = houses[house]['presentation']
+    if presentation:
+        file_path = presentation_path(house, presentation)
+        new_file_id = await answer_document_cached(call.message, file_path, houses[house]['presentation_file_id'])
+        if new_file_id:
+            await set_presentation_file_id(house, new_file_id, presentation=presentation)
+
+@callbacks.register(House)
+async def show_house(call: types.CallbackQuery, callback_data: House):
+    house = await get_house_by_id(callback_data.house_id)
+    if house is None:
+        return
+    keyboard = await house_card(callback_data.house_id)
+    if keyboard:
+        await render(call, f'Информация о проекте {house}', reply_markup=keyboard)
 
 
 
@@ -409,170 +271,132 @@ async def handle_commands(message: types.Message):
 
 
 # Редактирование конкретного дома
-@router.callback_query(lambda call: call.data.startswith("edit_house_"))
-async def edit_house_command(call: types.CallbackQuery):
-    house = call.data.split('_')[2]
-    builder = InlineKeyboardBuilder()
-
-    builder.button(text="Изменить Презентацию", callback_data=f"edit@presentation@{house}")
-    builder.button(text="Изменить Видео", callback_data=f"editlink@video@{house}")
-    builder.button(text="Изменить Рендоры", callback_data=f"editlink@renders@{house}")
-    builder.button(text="Изменить Эталонные текста", callback_data=f"editlink@reference@{house}")
-    builder.button(text="Изменить Видео для stories", callback_data=f"editlink@shorts_video@{house}")
-    builder.button(text="Изменить Дом продаж", callback_data=f"editlink@house_sales@{house}")
-    builder.button(text="Изменить Динамику", callback_data=f"editlink@dynamics@{house}")
-    builder.button(text="Изменить Выбрать квартиру", callback_data=f"editlink@choose_apartment@{house}")
-    builder.button(text="Изменить Запись на презу", callback_data=f"editlink@recording_presentation@{house}")
-
-
-    builder.button(text="НАЗАД", callback_data="edit_homes")
-    builder.adjust(1)
-
-    await call.message.answer(f'Редактирование проекта {house}', reply_markup=builder.as_markup())
+@callbacks.register(EditHouse)
+async def edit_house_command(call: types.CallbackQuery, callback_data: EditHouse):
+    house = await get_house_by_id(callback_data.house_id)
+    if house is None:
+        return
+    await render(call, f'Редактирование проекта {house}', reply_markup=await edit_house_menu(callback_data.house_id))
 
 # Добавление нового дома
-@router.callback_query(lambda call: call.data == "add_house")
+@callbacks.register("add_house")
 async def add_house_command(call: types.CallbackQuery, state: FSMContext):
     await state.set_state("add_house_name")
-    await call.message.answer("Введите название нового дома:")
+    await render(call, "Введите название нового дома:")
 
 @router.message(StateFilter("add_house_name"))
 async def process_add_house_name(message: types.Message, state: FSMContext):
     await state.update_data(house_name=message.text)
-    if '/' in message.text or '_' in message.text:
+    # Название используется как имя папки с презентацией
+    if '/' in message.text:
+        await state.clear()
+        await message.answer(f"Недопустимое название!", reply_markup=await back_menu("edit_homes"))
+    elif await add_house(message.text, "", "", "",  "", "", "", "", "", "") is None:
         await state.clear()
-        builder = InlineKeyboardBuilder()
-        builder.button(text="НАЗАД", callback_data="edit_homes")
-        builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-        builder.adjust(1)
-        await message.answer(f"Недопустимое название!", reply_markup=builder.as_markup())
+        await message.answer(f"Дом '{message.text}' уже есть!", reply_markup=await back_menu("edit_homes"))
     else:
-        add_house(message.text, "", "", "",  "", "", "", "", "", "")
         await state.clear()
-        builder = InlineKeyboardBuilder()
-        builder.button(text="НАЗАД", callback_data="edit_homes")
-        builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-        builder.adjust(1)
-        await message.answer(f"Новый дом '{message.text}' добавлен!", reply_markup=builder.as_markup())
+        await message.answer(f"Новый дом '{message.text}' добавлен!", reply_markup=await back_menu("edit_homes"))
 
-@router.callback_query(lambda call: call.data == "delete_house")
+@callbacks.register("delete_house")
 async def delete_house_command(call: types.CallbackQuery, state: FSMContext):
-    builder = InlineKeyboardBuilder()
-    houses = get_houses_data()
-    for house in houses:
-        builder.button(text=f"Удалить {house}", callback_data=f"confirm_delete_{house}")
-    
-    builder.button(text="НАЗАД", callback_data="edit_homes")
-    builder.adjust(1)
-    
-    await call.message.answer('Выберите дом для удаления:', reply_markup=builder.as_markup())
+    await render(call, 'Выберите дом для удаления:', reply_markup=await delete_house_menu())
 
-@router.callback_query(lambda call: call.data.startswith("confirm_delete_"))
-async def confirm_delete_house(call: types.CallbackQuery):
-    house = call.data.split('_')[2]
-    delete_house(house)
-    builder = InlineKeyboardBuilder()
-    builder.button(text="НАЗАД", callback_data="edit_homes")
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    builder.adjust(1)
-    await call.message.answer(f"Дом {house} удален!", reply_markup=builder.as_markup())
+@callbacks.register(ConfirmDeleteHouse)
+async def confirm_delete_house(call: types.CallbackQuery, callback_data: ConfirmDeleteHouse):
+    house = await get_house_by_id(callback_data.house_id)
+    if house is None:
+        return
+    await delete_house(house)
+    await render(call, f"Дом {house} удален!", reply_markup=await back_menu("edit_homes"))
 
 
-@router.callback_query(lambda call: call.data == "delete_lot")
+@callbacks.register("delete_lot")
 async def delete_lot_command(call: types.CallbackQuery, state: FSMContext):
-    builder = InlineKeyboardBuilder()
-    lots = get_favorite_houses()
-    for house in lots:
-        builder.button(text=f"Удалить {house} из лота", callback_data=f"confirm_lot_delete_{house}")
-    
-    builder.button(text="НАЗАД", callback_data="edit_lots")
-    builder.adjust(1)
-    
-    await call.message.answer('Выберите лот для удаления:', reply_markup=builder.as_markup())
-
-@router.callback_query(lambda call: call.data.startswith("confirm_lot_delete_"))
-async def confirm_delete_lot(call: types.CallbackQuery):
-    house = call.data.split('_')[3]
-    lots = get_favorite_houses()
-    del lots[house]
-    remove_favorite_house(house)
-    builder = InlineKeyboardBuilder()
-    builder.button(text="НАЗАД", callback_data="edit_lots")
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    builder.adjust(1)
-    await call.message.answer(f"Дом {house} удален из лота недели!", reply_markup=builder.as_markup())
-
-
-@router.callback_query(lambda call: call.data == "add_lot")
+    await render(call, 'Выберите лот для удаления:', reply_markup=await delete_lot_menu())
+
+@callbacks.register(ConfirmDeleteLot)
+async def confirm_delete_lot(call: types.CallbackQuery, callback_data: ConfirmDeleteLot):
+    house = await get_house_by_id(callback_data.house_id)
+    if house is None:
+        return
+    await remove_favorite_house(house)
+    await render(call, f"Дом {house} удален из лота недели!", reply_markup=await back_menu("edit_lots"))
+
+
+@callbacks.register("add_lot")
 async def add_lot_command(call: types.CallbackQuery, state: FSMContext):
-    builder = InlineKeyboardBuilder()
-    lots = get_favorite_houses()
-    houses = get_houses_data()
-    flag = False
-    for house in houses:
-        if house not in lots:
-            flag = True
-            builder.button(text=f"Добавить {house} в лоты", callback_data=f"confirm_add_lot_{house}")
-    
-    builder.button(text="НАЗАД", callback_data="edit_lots")
-    builder.adjust(1)
-    
+    flag, keyboard = await add_lot_menu()
+
     if flag:
-        await call.message.answer('Выберите лот для добавления:', reply_markup=builder.as_markup())
+        await render(call, 'Выберите лот для добавления:', reply_markup=keyboard)
     else:
-        await call.message.answer('Все дома доступные в продаже уже добавлены в "Лоты недели"', reply_markup=builder.as_markup())
+        await render(call, 'Все дома доступные в продаже уже добавлены в "Лоты недели"', reply_markup=keyboard)
 
-@router.callback_query(lambda call: call.data.startswith("confirm_add_lot_"))
-async def confirm_add_lot(call: types.CallbackQuery):
-    house = call.data.split('_')[3]
-    add_favorite_house(house)
-    builder = InlineKeyboardBuilder()
-    builder.button(text="НАЗАД", callback_data="edit_lots")
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    builder.adjust(1)
-    await call.message.answer(f"Дом {house} добавлен в лоты!", reply_markup=builder.as_markup())
+@callbacks.register(ConfirmAddLot)
+async def confirm_add_lot(call: types.CallbackQuery, callback_data: ConfirmAddLot):
+    house = await get_house_by_id(callback_data.house_id)
+    if house is None:
+        return
+    await add_favorite_house(house)
+    await render(call, f"Дом {house} добавлен в лоты!", reply_markup=await back_menu("edit_lots"))
 
 
 # Обработка нажатия на кнопку для редактирования презентации
-@router.callback_query(lambda call: call.data.startswith("edit@presentation@"))
-async def edit_presentation(call: types.CallbackQuery, state: FSMContext):
-    house = call.data.split('@')[2]
-    await state.update_data(house=house)
-    await call.message.answer(f"Отправьте новый файл для презентации для {house}.")
+@callbacks.register(EditPresentation)
+async def edit_presentation(call: types.CallbackQuery, callback_data: EditPresentation, state: FSMContext):
+    house = await get_house_by_id(callback_data.house_id)
+    if house is None:
+        return
+    await state.update_data(house_id=callback_data.house_id)
+    await render(call, f"Отправьте новый файл для презентации для {house}.")
     await state.set_state("waiting_for_presentation_file")
 
 # Обработка отправки нового файла презентации
 @router.message(StateFilter("waiting_for_presentation_file"))
 async def process_presentation_file(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    house = data.get("house")
+    house = await get_house_by_id(data.get("house_id"))
+    if house is None:
+        # Дом успели удалить, пока админ готовил изменения
+        await state.clear()
+        await message.answer("Дом не найден.", reply_markup=await back_menu("edit_homes"))
+        return
     document = message.document
-    
-    file_name = f"{document.file_name}"
-    file_path = f"./{house}/{file_name}"
-    if not os.path.exists(house):
-        os.makedirs(house)
-    await bot.download(document, destination=file_path)
-    houses = get_houses_data()
-    houses[house]["presentation"] = file_name
-    update_house(house, "presentation", file_name)
-    
+    if document is None:
+        await message.answer("Отправьте презентацию файлом.")
+        return
+
     await state.clear()
-    
-    builder = InlineKeyboardBuilder()
-    builder.button(text="НАЗАД", callback_data="edit_homes")
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    builder.adjust(1)
 
-    await message.answer(f"Презентация для {house} обновлена.", reply_markup=builder.as_markup())
+    houses = await get_houses_data()
+    current = houses[house]['presentation']
+    file_name = safe_file_name(document)
+
+    async def on_done(changed):
+        if not changed:
+            return f"Презентация для {house} не изменилась."
+        if house not in await get_houses_data():
+            return "Дом не найден."
+        await update_house(house, "presentation", file_name)
+        # Присланный админом документ уже лежит в Telegram, его file_id можно сразу переиспользовать
+        await set_presentation_file_id(house, document.file_id)
+        return f"Презентация для {house} обновлена."
+
+    # Файл скачивается в фоне, обработчик не ждет окончания загрузки
+    await start_upload(
+        message, document, presentation_path(house, file_name), on_done,
+        compare_with=presentation_path(house, current) if current else None,
+        reply_markup=await back_menu("edit_homes")
+    )
 
 
 # Обработка нажатия на кнопку для редактирования презентации
-@router.callback_query(lambda call: call.data.startswith("edit@rule@"))
-async def edit_rule_file(call: types.CallbackQuery, state: FSMContext):
-    rule = call.data.split('@')[2]
+@callbacks.register(EditRule)
+async def edit_rule_file(call: types.CallbackQuery, callback_data: EditRule, state: FSMContext):
+    rule = callback_data.rule
     await state.update_data(rule=rule)
-    await call.message.answer(f"Отправьте новый файл для {extra_dict[rule]}.")
+    await render(call, f"Отправьте новый файл для {extra_dict[rule]}.")
     await state.set_state("waiting_for_rule_file")
 
 # Обработка отправки нового файла презентации
@@ -581,230 +405,422 @@ async def process_rule_file(message: types.Message, state: FSMContext):
     data = await state.get_data()
     rule = data.get("rule")
     document = message.document
-    
-    file_name = f"{document.file_name}"
-    file_path = f"./rules/{file_name}"
+    if document is None:
+        await message.answer("Отправьте документ файлом.")
+        return
 
-    await bot.download(document, destination=file_path)
-    update_pdf_file(rule, file_path)
-    
     await state.clear()
-    
-    builder = InlineKeyboardBuilder()
-    builder.button(text="НАЗАД", callback_data="edit_rules")
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    builder.adjust(1)
 
-    await message.answer(f"Документ для {extra_dict[rule]} обновлен.", reply_markup=builder.as_markup())
+    current, _ = await get_pdf_document(rule)
+    file_path = f"./rules/{safe_file_name(document)}"
+
+    async def on_done(changed):
+        if not changed:
+            return f"Документ для {extra_dict[rule]} не изменился."
+        await update_pdf_file(rule, file_path)
+        await set_pdf_file_id(rule, document.file_id)
+        return f"Документ для {extra_dict[rule]} обновлен."
+
+    await start_upload(
+        message, document, file_path, on_done,
+        compare_with=current, reply_markup=await back_menu("edit_rules")
+    )
 
 
 
-@router.callback_query(lambda call: call.data.startswith("editlink@"))
-async def edit_link(call: types.CallbackQuery, state: FSMContext):
-    arg = call.data.split('@')[1]
-    house = call.data.split('@')[2]
-    await state.update_data(house=house)
+@callbacks.register(EditLink)
+async def edit_link(call: types.CallbackQuery, callback_data: EditLink, state: FSMContext):
+    arg = callback_data.field
+    house = await get_house_by_id(callback_data.house_id)
+    if house is None or arg not in HOUSE_FIELDS:
+        return
+    await state.update_data(house_id=callback_data.house_id)
     await state.update_data(arg=arg)
-    await call.message.answer(f"Отправьте новую ссылку.")
+    await render(call, f"Отправьте новую ссылку.")
     await state.set_state("waiting_for_link")
 
 
 @router.message(StateFilter("waiting_for_link"))
 async def process_link(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    house = data.get("house")
+    house = await get_house_by_id(data.get("house_id"))
+    if house is None:
+        # Дом успели удалить, пока админ готовил изменения
+        await state.clear()
+        await message.answer("Дом не найден.", reply_markup=await back_menu("edit_homes"))
+        return
     arg = data.get("arg")
     new_link = message.text
+    if not new_link:
+        await message.answer("Отправьте ссылку текстом.")
+        return
 
-    houses = get_houses_data()
-
-    houses[house][arg] = new_link
-    update_house(house, arg, new_link)
+    await update_house(house, arg, new_link)
     
     await state.clear()
     
-    builder = InlineKeyboardBuilder()
-    builder.button(text="НАЗАД", callback_data="edit_homes")
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    builder.adjust(1)
+    await message.answer(f"Данные для {house} обновлены.", reply_markup=await back_menu("edit_homes"))
 
-    await message.answer(f"Данные для {house} обновлены.", reply_markup=builder.as_markup())
 
 
 
+# Показ Запись на презентацию
+async def show_check(target):
+    await render(target, "Проверьте на уникальность и запишите клиента на презентацию", reply_markup=await check_menu())
 
-# Обработка нажатий на кнопки в главном меню
-@router.callback_query()
-async def handle_callback_query(call: CallbackQuery):
-    if call.data == "rules":
-        await show_rules_menu(call.message)
-    elif call.data == "houses_for_sale":
-        await show_houses(call.message)
-    elif call.data == "lot_of_the_week":
-        await show_lots(call.message)
-    elif call.data == "call_us":
-        await show_call(call.message)
-    elif call.data == "broker_tour":
-        await show_broker_tour(call.message)
-    elif call.data =='edit_homes':
-        await edit_homes_command(call.message)
-    elif call.data =='edit_lots':
-        await edit_lots_command(call.message)
-    elif call.data =='edit_rules':
-        await edit_rules_command(call.message)
-        
-    elif call.data == "main_menu":  # Добавляем обработку для кнопки "ГЛАВНОЕ МЕНЮ"
-        await call.message.answer("ГЛАВНОЕ МЕНЮ", reply_markup=main_menu())
+# Показ Дома в продаже
+async def show_houses(target):
+    await render(target, '🏠 ДОМА В ПРОДАЖЕ', reply_markup=await houses_menu())
 
+async def show_lots(target):
+    has_lots, keyboard = await lots_menu()
 
-# Показ Запись на презентацию
-async def show_check(message: types.Message):
-    builder = InlineKeyboardBuilder()
+    if has_lots:
+        await render(target, '💫 ЛОТ НЕДЕЛИ', reply_markup=keyboard)
+    else:
+        await render(target, '💫 ЛОТ НЕДЕЛИ ОТСУТСТВУЕТ', reply_markup=keyboard)
 
-    builder.button(text="Проверить на уникальность", url="https://tavrida-development.ru/business/partner/uniqueness/")
-    builder.button(text="Записать на презентацию", url="https://tavrida-development.ru/business/partner/presentation/")
+# Показ Брокер-тура
+async def show_broker_tour(target):
+    await render(target, 'Запись на брокер-тур — https://tavrida-development.ru/business/partner/tour/\nНажимайте, ждем ваш звонок: +74994330801', reply_markup=await main_menu_button())
 
-    builder.adjust(1)
 
-    await message.answer("Проверьте на уникальность и запишите клиента на презентацию", reply_markup=builder.as_markup())
+# Показ Позвонить
+async def show_call(target):
+    await render(target, 'Нажимайте, ждем ваш звонок: +74994330801', reply_markup=await main_menu_button())
 
-# Показ Дома в продаже
-async def show_houses(message: types.Message):
-    builder = InlineKeyboardBuilder()
-    houses = get_houses_data()
-    for house in houses:
-        builder.button(text=house, callback_data=f"house_{house}")
+# Показ правил
+async def show_rules_menu(target):
+    await render(target, "ПРАВИЛА РАБОТЫ", reply_markup=await rules_menu())
 
 
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    
-    builder.adjust(1)
 
-    await message.answer('🏠 ДОМА В ПРОДАЖЕ', reply_markup=builder.as_markup())
 
-async def show_lots(message: types.Message):
-    builder = InlineKeyboardBuilder()
-    lots = get_favorite_houses()
-    for house in lots:
-        builder.button(text=house, callback_data=f"house_{house}")
+@router.message(Command(commands=['edit_homes']))
+async def edit_homes_command(target):
+    await render(target, 'Редактирование домов', reply_markup=await edit_homes_menu())
 
 
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    
-    builder.adjust(1)
-    
-    if lots:
-        await message.answer('💫 ЛОТ НЕДЕЛИ', reply_markup=builder.as_markup())
-    else:
-        await message.answer('💫 ЛОТ НЕДЕЛИ ОТСУТСТВУЕТ', reply_markup=builder.as_markup())
+@router.message(Command(commands=['edit_lots']))
+async def edit_lots_command(target):
+    await render(target, 'Редактирование лота недели', reply_markup=await edit_lots_menu())
 
-# Показ Брокер-тура
-async def show_broker_tour(message: types.Message):
-    builder = InlineKeyboardBuilder()
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    
-    builder.adjust(1)
 
-    await message.answer('Запись на брокер-тур — https://tavrida-development.ru/business/partner/tour/\nНажимайте, ждем ваш звонок: +74994330801', reply_markup=builder.as_markup())
+@router.message(Command(commands=['edit_rules']))
+async def edit_rules_command(target):
+    await render(target, 'Редактирование Правила работы', reply_markup=await edit_rules_menu())
+
+
+# Показ главного меню
+async def show_main_menu(target):
+    await render(target, "ГЛАВНОЕ МЕНЮ", reply_markup=await main_menu())
+
+
+# Кнопки меню, которые просто открывают раздел
+menu_sections = {
+    "rules": show_rules_menu,
+    "houses_for_sale": show_houses,
+    "lot_of_the_week": show_lots,
+    "call_us": show_call,
+    "broker_tour": show_broker_tour,
+    "edit_homes": edit_homes_command,
+    "edit_lots": edit_lots_command,
+    "edit_rules": edit_rules_command,
+    "main_menu": show_main_menu,
+}
 
+for action, show_section in menu_sections.items():
+    callbacks.register(action)(lambda call, show_section=show_section: show_section(call))
 
-# Показ Позвонить
-async def show_call(message: types.Message):
-    builder = InlineKeyboardBuilder()
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    
-    builder.adjust(1)
 
-    await message.answer('Нажимайте, ждем ваш звонок: +74994330801', reply_markup=builder.as_markup())
+# Списки домов по страницам: имя списка -> клавиатура
+paged_menus = {
+    "houses": houses_menu,
+    "lots": lots_menu,
+    "edit_homes": edit_homes_menu,
+    "delete_house": delete_house_menu,
+    "add_lot": add_lot_menu,
+    "delete_lot": delete_lot_menu,
+}
 
-# Показ правил
-async def show_rules_menu(message: types.Message):
-    builder = InlineKeyboardBuilder()
-    builder.button(text="Регламент", callback_data="send_pdf_reglament")
-    builder.button(text="Агентский договор", callback_data="send_pdf_contract")
-    builder.button(text="Правила рекламы", callback_data="send_pdf_ad_rules")
-    builder.button(text="Правила фото и видео", callback_data="send_pdf_photo_video_rules")
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    
-    builder.adjust(1)
 
-    await message.answer("ПРАВИЛА РАБОТЫ", reply_markup=builder.as_markup())
+# Листание меняет только кнопки в том же сообщении, новое сообщение не отправляется
+@callbacks.register(ListPage)
+async def list_page(call: types.CallbackQuery, callback_data: ListPage):
+    menu = paged_menus.get(callback_data.menu)
+    if menu is None:
+        return
+    keyboard = await menu(await page_start(callback_data.start_id))
+    if isinstance(keyboard, tuple):
+        keyboard = keyboard[1]
+    try:
+        await call.message.edit_reply_markup(reply_markup=keyboard)
+    except TelegramBadRequest:
+        # Страница не изменилась (повторное нажатие)
+        pass
 
 
+# Все нажатия на кнопки проходят через один обработчик и распределяются по префиксу
+@router.callback_query()
+async def handle_callback_query(call: CallbackQuery, state: FSMContext):
+    # Нажатие подтверждаем сразу, чтобы у пользователя не крутились часики на кнопке.
+    # На нажатия старше ~15 секунд (накопились за время перезапуска или ждали очереди) Telegram отвечает ошибкой,
+    # но само нажатие все равно обрабатываем
+    try:
+        await call.answer()
+    except TelegramAPIError:
+        pass
+    if not await callbacks.dispatch(call, state=state):
+        # Кнопка из старого меню, например house_<название> до перехода на id домов
+        await render(call, "Это меню устарело, откройте актуальное:", reply_markup=await main_menu())
+
+
+# Выгрузка каталога файлом: /give_array (JSON) или /give_array csv
+@router.message(Command(commands=['give_array']))
+async def get_array(message: types.Message, command: CommandObject):
+    fmt = (command.args or EXPORT_FORMATS[0]).strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        await message.answer(f"Доступные форматы выгрузки: {', '.join(EXPORT_FORMATS)}.")
+        return
+
+    export = await export_houses(fmt)
+    if export['file_id']:
+        try:
+            await message.answer_document(export['file_id'])
+            return
+        except TelegramBadRequest:
+            pass
+
+    sent = await message.answer_document(BufferedInputFile(export['content'], filename=f"houses.{fmt}"))
+    transfer_bytes_total.inc(len(export['content']), direction='upload')
+    export['file_id'] = sent.document.file_id
+
+
+# Поиск по каталогу домов: /search запрос или /search и запрос следующим сообщением
+@router.message(Command(commands=['search']))
+async def search_command(message: types.Message, command: CommandObject, state: FSMContext):
+    if command.args:
+        await show_search_results(message, command.args, state)
+    else:
+        await state.set_state("waiting_for_search")
+        await message.answer("Введите название дома или его часть:")
 
 
-@router.message(Command(commands=['edit_homes']))
-async def edit_homes_command(message: types.Message):
-    builder = InlineKeyboardBuilder()
+@router.message(StateFilter("waiting_for_search"))
+async def process_search(message: types.Message, state: FSMContext):
+    await state.set_state(None)
+    if message.text:
+        await show_search_results(message, message.text, state)
 
-    houses = get_houses_data()
-    
-    for house in houses:
-        builder.button(text=f"Редактировать {house}", callback_data=f"edit_house_{house}")
-    
-    builder.button(text="Добавить новый дом", callback_data="add_house")
-    builder.button(text="Удалить существующий дом", callback_data="delete_house")
-    
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    
-    builder.adjust(1)
-    await message.answer('Редактирование домов', reply_markup=builder.as_markup())
 
+async def show_search_results(message: types.Message, query, state: FSMContext):
+    results = await search_houses(query)
+    if not results:
+        await message.answer(f'По запросу "{query}" ничего не найдено.', reply_markup=await main_menu_button())
+        return
 
-@router.message(Command(commands=['edit_lots']))
-async def edit_lots_command(message: types.Message):
-    builder = InlineKeyboardBuilder()
-            
-    builder.button(text="Добавить новый лот", callback_data="add_lot")
-    builder.button(text="Удалить существующий лот", callback_data="delete_lot")
-    
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    
-    builder.adjust(1)
-    await message.answer('Редактирование лота недели', reply_markup=builder.as_markup())
+    # Запрос запоминаем для листания страниц, в данные кнопок он может не поместиться
+    await state.update_data(search_query=query)
+    await message.answer(f'Найдено домов: {len(results)}', reply_markup=await search_results_menu(results, 0))
 
 
-@router.message(Command(commands=['edit_rules']))
-async def edit_rules_command(message: types.Message):
-    builder = InlineKeyboardBuilder()
+@callbacks.register(SearchPage)
+async def search_page(call: types.CallbackQuery, callback_data: SearchPage, state: FSMContext):
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        await render(call, "Поиск устарел, повторите /search", reply_markup=await main_menu_button())
+        return
+    results = await search_houses(query)
+    try:
+        await call.message.edit_reply_markup(reply_markup=await search_results_menu(results, callback_data.page))
+    except TelegramBadRequest:
+        # Страница не изменилась (повторное нажатие)
+        pass
 
-    rules = get_pdf_files() 
-    
-    for rule in rules:        
-        builder.button(text=f"Редактировать {extra_dict[rule]}", callback_data=f"edit@rule@{rule}")
-    
-    builder.button(text="ГЛАВНОЕ МЕНЮ", callback_data="main_menu")
-    
-    builder.adjust(1)
-    await message.answer('Редактирование Правила работы', reply_markup=builder.as_markup())
 
+# Сколько домов отдаем в inline-режиме за один запрос
+INLINE_PAGE_SIZE = 20
 
-@router.message(Command(commands=['give_array']))
-async def get_array(message: types.Message):
-    houses = get_houses_data()
-    await message.answer(str(houses))
+
+# Inline-режим: @бот запрос в любом чате. Пустой запрос показывает весь каталог
+@router.inline_query()
+async def inline_search(inline_query: types.InlineQuery):
+    houses = await get_houses_data()
+    query = inline_query.query.strip()
+    if query:
+        results = await search_houses(query)
+    else:
+        results = [(info['id'], house) for house, info in houses.items()]
+
+    # offset присылает клиент, это строка из нашего next_offset или произвольное значение
+    offset = int(inline_query.offset) if inline_query.offset.isdecimal() else 0
+    articles = []
+    for house_id, house in results[offset:offset + INLINE_PAGE_SIZE]:
+        info = houses.get(house)
+        if info is None:
+            continue
+        lines = [f'Информация о проекте {house}']
+        lines += [f'{text}: {info[field]}' for text, field in HOUSE_LINKS if info[field]]
+        articles.append(InlineQueryResultArticle(
+            id=str(house_id),
+            title=house,
+            input_message_content=InputTextMessageContent(message_text='\n'.join(lines))
+        ))
+
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(results) else ''
+    await inline_query.answer(articles, cache_time=60, next_offset=next_offset)
+
+
+# Рассылка лота недели всем зарегистрированным брокерам
+@router.message(Command(commands=['broadcast']))
+async def broadcast_command(message: types.Message, state: FSMContext):
+    if message.chat.id not in ADMIN_IDS:
+        return
+    await state.set_state("waiting_for_broadcast_text")
+    await message.answer("Отправьте текст рассылки. К сообщению будут добавлены кнопки лота недели.")
+
+
+@router.message(StateFilter("waiting_for_broadcast_text"))
+async def process_broadcast_text(message: types.Message, state: FSMContext, broadcaster: Broadcaster):
+    await state.clear()
+    if message.chat.id not in ADMIN_IDS or not message.text:
+        return
+    _, keyboard = await lots_menu()
+    broadcast_id = await broadcaster.start(message.text, message.chat.id, reply_markup=keyboard)
+    await message.answer(f"Рассылка #{broadcast_id} запущена. Отчет придет по завершении, текущий прогресс: /broadcast_status")
+
+
+@router.message(Command(commands=['broadcast_status']))
+async def broadcast_status_command(message: types.Message, broadcaster: Broadcaster):
+    if message.chat.id not in ADMIN_IDS:
+        return
+    report = await broadcaster.last_report()
+    await message.answer(report or "Рассылок еще не было.")
 
 
 # Запуск бота
 async def main():
-    conn = sqlite3.connect('data.db')
-    cursor = conn.cursor()
-
-    # Создаем таблицу избранных домов
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS favorite_houses (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        house_id INTEGER NOT NULL,
-        FOREIGN KEY (house_id) REFERENCES houses (id) ON DELETE CASCADE
+    # Применяем недостающие миграции схемы, при актуальной схеме это одно чтение версии
+    await migrate()
+
+    # Изменения данных в других процессах бота приходят через транспорт и обновляют кэши этого процесса
+    change_transport = create_change_transport()
+    await change_transport.start()
+
+    # Загружаем каталог домов в кэш
+    await load_houses_data()
+    changes_task = asyncio.create_task(listen_changes(change_transport))
+
+    bot = create_bot()
+    dp = create_dispatcher(bot)
+
+    # Продолжаем рассылки, прерванные остановкой бота, в том числе остановкой других процессов
+    _, keyboard = await lots_menu()
+    broadcasts_task = asyncio.create_task(dp["broadcaster"].watch(reply_markup=keyboard))
+
+    # Проверка файлов документов и заранее загрузка недостающих file_id
+    assets_task = asyncio.create_task(AssetScanner(bot, ASSET_CHAT_ID).run())
+
+    metrics_runner = None
+    metrics_log_task = None
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, int(METRICS_PORT))
+    if METRICS_LOG_INTERVAL:
+        metrics_log_task = asyncio.create_task(log_metrics(METRICS_LOG_INTERVAL))
+
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(bot, dp)
+        else:
+            await run_polling(bot, dp)
+    finally:
+        changes_task.cancel()
+        assets_task.cancel()
+        broadcasts_task.cancel()
+        await wait_in_flight(dp)
+        await dp["broadcaster"].stop()
+
+        # Дописываем регистрации, которые еще не попали в базу
+        await flush_users()
+        if metrics_log_task:
+            metrics_log_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        close_db()
+
+
+# Новые обновления больше не принимаются: дожидаемся уже полученных и загрузок файлов,
+# пока сессия бота еще открыта
+async def wait_in_flight(dp):
+    if not await dp["in_flight"].wait_idle(SHUTDOWN_TIMEOUT):
+        logging.warning("Не дождались обработки обновлений за %s с", SHUTDOWN_TIMEOUT)
+    if upload_tasks:
+        await asyncio.wait(upload_tasks, timeout=SHUTDOWN_TIMEOUT)
+
+
+# SIGTERM и SIGINT при деплое останавливают прием обновлений, а не обрывают процесс
+def create_stop_event():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+# Запуск в режиме long polling
+async def run_polling(bot, dp):
+    # Webhook, оставшийся от запуска в режиме webhook, мешает getUpdates, поэтому снимаем его
+    await bot.delete_webhook(drop_pending_updates=False)
+
+    # Каждое обновление обрабатывается отдельной задачей, ограничения задают UPDATE_CONCURRENCY и events_isolation.
+    # Неподтвержденные обновления Telegram хранит, поэтому при перезапуске они не теряются.
+    # Сигналы обрабатываем сами: при остановке start_polling сразу закрывает хранилище FSM,
+    # а полученные обновления к этому моменту должны быть обработаны
+    stop = create_stop_event()
+    polling = asyncio.create_task(
+        dp.start_polling(bot, handle_as_tasks=True, handle_signals=False, close_bot_session=False)
+    )
+    stop_wait = asyncio.create_task(stop.wait())
+    await asyncio.wait((polling, stop_wait), return_when=asyncio.FIRST_COMPLETED)
+    stop_wait.cancel()
+    if not polling.done():
+        await wait_in_flight(dp)
+        await dp.stop_polling()
+    await polling
+
+
+# Запуск в режиме webhook: Telegram сам присылает обновления на встроенный aiohttp сервер
+async def run_webhook(bot, dp):
+    # aiohttp сервер нужен только в режиме webhook
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+    from aiohttp import web
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    # Сервер поднимается до регистрации webhook, чтобы сразу принимать обновления
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    logging.info("Webhook сервер запущен на %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+
+    # Накопленные обновления не сбрасываются: пока бот перезапускается, Telegram повторяет доставку
+    await bot.set_webhook(
+        f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(), drop_pending_updates=False
     )
-    ''')
 
-    # Сохраняем изменения
-    conn.commit()
-    conn.close()
-    dp.include_router(router)
-    await dp.start_polling(bot)
+    stop = create_stop_event()
+    try:
+        await stop.wait()
+    finally:
+        # Сначала перестаем принимать запросы, сессию бота runner закроет после обработки полученных
+        await site.stop()
+        await wait_in_flight(dp)
+        await runner.cleanup()
 
 if __name__ == '__main__':
-    import asyncio
     asyncio.run(main())
@@ -0,0 +1,200 @@
+import asyncio
+import bisect
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+
+# Границы корзин гистограмм задержек, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Все созданные метрики, в порядке создания
+registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # значения меток -> значение метрики
+        self.values = {}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_pairs(self, key):
+        return list(zip(self.labelnames, key))
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, value in self.values.items():
+            lines.append(f'{self.name}{_format_labels(self._label_pairs(key))} {value}')
+        return lines
+
+    def snapshot(self):
+        return {','.join(key) or '': value for key, value in self.values.items()}
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # [количество в каждой корзине, сумма, общее количество]
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    # Замер времени выполнения блока кода
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, (counts, total, count) in self.values.items():
+            pairs = self._label_pairs(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(pairs + [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(pairs + [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(pairs)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(pairs)} {count}')
+        return lines
+
+    # Оценка квантиля по корзинам: верхняя граница корзины, в которую он попадает
+    @staticmethod
+    def _quantile(buckets, counts, count, q):
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        result = {}
+        for key, (counts, total, count) in self.values.items():
+            result[','.join(key)] = {
+                'count': count,
+                'sum': round(total, 6),
+                'p50': self._quantile(self.buckets, counts, count, 0.5),
+                'p99': self._quantile(self.buckets, counts, count, 0.99),
+            }
+        return result
+
+
+# Метрики бота
+updates_total = Counter('bot_updates_total', 'Полученные обновления', ('type',))
+updates_in_progress = Gauge('bot_updates_in_progress', 'Обновления, которые сейчас обрабатываются')
+update_seconds = Histogram('bot_update_seconds', 'Полное время обработки обновления', ('type',))
+handler_seconds = Histogram('bot_handler_seconds', 'Время работы обработчиков', ('handler',))
+db_query_seconds = Histogram('bot_db_query_seconds', 'Время запросов к базе', ('query',))
+telegram_api_seconds = Histogram('bot_telegram_api_seconds', 'Время запросов к Telegram Bot API', ('method',))
+telegram_api_errors_total = Counter('bot_telegram_api_errors_total', 'Ошибки запросов к Telegram Bot API', ('method',))
+transfer_bytes_total = Counter('bot_transfer_bytes_total', 'Скачанные и загруженные байты файлов', ('direction',))
+cache_requests_total = Counter('bot_cache_requests_total', 'Обращения к кэшам', ('cache', 'result'))
+
+
+def cache_hit(cache, hit):
+    cache_requests_total.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+# Все метрики в текстовом формате Prometheus
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Все метрики одним словарем для JSON
+def metrics_snapshot():
+    return {metric.name: metric.snapshot() for metric in registry}
+
+
+async def _metrics_handler(request):
+    from aiohttp import web
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+
+async def _metrics_json_handler(request):
+    from aiohttp import web
+    return web.json_response(metrics_snapshot(), dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+
+def setup_metrics_routes(app):
+    app.router.add_get('/metrics', _metrics_handler)
+    app.router.add_get('/metrics.json', _metrics_json_handler)
+
+
+# Отдельный HTTP сервер для метрик, aiohttp.web загружается только если сервер нужен
+async def start_metrics_server(host, port):
+    from aiohttp import web
+
+    app = web.Application()
+    setup_metrics_routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
+
+
+# Периодическая запись всех метрик в лог одной JSON строкой
+async def log_metrics(interval):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(json.dumps({'metrics': metrics_snapshot()}, ensure_ascii=False))
@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, Message
+
+from callbacks import SEPARATOR
+from metrics import updates_total, updates_in_progress, update_seconds, handler_seconds, telegram_api_seconds, \
+    telegram_api_errors_total
+from ratelimit import KeyedTokenBuckets
+
+
+# Обычные сообщения и нажатия: до 2 в секунду на чат, всплеск до 5
+RATE = 2
+CAPACITY = 5
+
+# Кнопки, которые отправляют тяжелые файлы: одна отправка в 5 секунд на чат, всплеск до 3
+HEAVY_RATE = 0.2
+HEAVY_CAPACITY = 3
+
+# Предупреждение о пропущенном сообщении: не чаще одного в 5 секунд на чат
+WARNING_RATE = 0.2
+
+# Повторное нажатие на ту же кнопку сразу после нее в течение этого времени (секунд) считается одним
+DUPLICATE_WINDOW = 2
+
+
+# Ограничение частоты запросов от одного чата и склейка повторных нажатий на одну кнопку.
+# Лишние обновления отбрасываются до фильтров и обработчиков
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, heavy_prefixes=(), rate=RATE, capacity=CAPACITY, heavy_rate=HEAVY_RATE,
+                 heavy_capacity=HEAVY_CAPACITY, duplicate_window=DUPLICATE_WINDOW):
+        self.heavy_prefixes = set(heavy_prefixes)
+        self.buckets = KeyedTokenBuckets(rate, capacity)
+        self.heavy_buckets = KeyedTokenBuckets(heavy_rate, heavy_capacity)
+        self.warning_buckets = KeyedTokenBuckets(WARNING_RATE, 1)
+        self.duplicate_window = duplicate_window
+        # chat_id -> (данные последней нажатой кнопки, время нажатия)
+        self.last_taps = {}
+
+    # Дубликат - только повтор предыдущего нажатия в этом чате. Переходы туда и обратно
+    # (список -> дом -> НАЗАД к списку) не склеиваются, между ними есть другие нажатия
+    def _is_duplicate(self, chat_id, callback_data):
+        now = time.monotonic()
+        if len(self.last_taps) > 10000:
+            self.last_taps = {
+                key: (data, tapped_at) for key, (data, tapped_at) in self.last_taps.items()
+                if now - tapped_at < self.duplicate_window
+            }
+
+        last_tap = self.last_taps.get(chat_id)
+        self.last_taps[chat_id] = (callback_data, now)
+        return last_tap is not None and last_tap[0] == callback_data and now - last_tap[1] < self.duplicate_window
+
+    async def __call__(self, handler, event, data):
+        chat = data.get('event_chat')
+        user = data.get('event_from_user')
+        chat_id = chat.id if chat else user.id if user else None
+        if chat_id is None:
+            return await handler(event, data)
+
+        if isinstance(event, CallbackQuery) and event.data:
+            if self._is_duplicate(chat_id, event.data):
+                await self._answer(event)
+                return None
+
+            prefix = event.data.split(SEPARATOR, 1)[0]
+            if prefix in self.heavy_prefixes and not self.heavy_buckets.try_acquire(chat_id):
+                await self._answer(event, "Файл уже отправлен, подождите немного.")
+                return None
+
+        if not self.buckets.try_acquire(chat_id):
+            if isinstance(event, CallbackQuery):
+                await self._answer(event, "Слишком много запросов, подождите немного.")
+            elif isinstance(event, Message) and data.get('raw_state') is not None:
+                # Сообщение с ответом на шаг регистрации или ввода админа пропало бы молча,
+                # а состояние продолжало бы его ждать
+                await self._warn(event, chat_id)
+            return None
+
+        return await handler(event, data)
+
+    async def _warn(self, message, chat_id):
+        if not self.warning_buckets.try_acquire(chat_id):
+            return
+        try:
+            await message.answer("Слишком много сообщений, подождите немного и отправьте последнее еще раз.")
+        except TelegramAPIError:
+            pass
+
+    # Ответ на нажатие убирает часики на кнопке у пользователя
+    async def _answer(self, call, text=None):
+        try:
+            await call.answer(text)
+        except TelegramAPIError:
+            pass
+
+
+# Счетчик и время обработки всех обновлений, число обновлений в работе
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        update_type = event.event_type
+        updates_total.inc(type=update_type)
+        updates_in_progress.inc()
+        try:
+            with update_seconds.time(type=update_type):
+                return await handler(event, data)
+        finally:
+            updates_in_progress.dec()
+
+
+# Время работы обработчиков сообщений, метка - имя функции обработчика
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        with handler_seconds.time(handler=name):
+            return await handler(event, data)
+
+
+# Время и ошибки запросов к Telegram Bot API
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        try:
+            with telegram_api_seconds.time(method=name):
+                return await make_request(bot, method)
+        except TelegramAPIError:
+            telegram_api_errors_total.inc(method=name)
+            raise
+
+
+# Ограничение числа обновлений, которые обрабатываются одновременно. Порядок внутри чата
+# обеспечивает блокировка FSM (events_isolation), она берется раньше этого ограничения
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self.semaphore:
+            return await handler(event, data)
+
+
+# Число полученных, но еще не обработанных обновлений. Регистрируется раньше блокировки FSM,
+# поэтому учитывает и обновления, которые ждут предыдущее обновление своего чата
+class InFlightMiddleware(BaseMiddleware):
+    def __init__(self):
+        self.active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.active += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.active -= 1
+            if not self.active:
+                self._idle.set()
+
+    # Ожидание, пока обработаются все уже полученные обновления. False, если не дождались
+    async def wait_idle(self, timeout):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
@@ -0,0 +1,235 @@
+import logging
+import os
+import shutil
+import sqlite3
+
+from assets import presentation_path
+from data import data_pool, run_db
+
+
+# Отдельная база пользователей из прошлых версий бота, ее данные переносятся в data.db
+LEGACY_USERS_DB = 'users.db'
+
+
+# Версионные миграции схемы. Номер примененной миграции хранится в PRAGMA user_version самой базы,
+# поэтому при обычном запуске проверка сводится к чтению одного числа.
+# Новые изменения схемы добавляются только в конец списков, уже выпущенные миграции не меняются.
+# Первые миграции написаны через IF NOT EXISTS, так как базы, созданные до появления миграций, уже содержат часть таблиц
+
+
+def add_missing_column(cursor, table, column, column_type):
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+
+def _data_v1_base_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS houses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        presentation TEXT,
+        video TEXT,
+        renders TEXT,
+        reference TEXT,
+        shorts_video TEXT,
+        house_sales TEXT,
+        dynamics TEXT,
+        choose_apartment TEXT,
+        recording_presentation TEXT
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS favorite_houses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        house_id INTEGER NOT NULL,
+        FOREIGN KEY (house_id) REFERENCES houses (id) ON DELETE CASCADE
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pdf_files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        command TEXT NOT NULL,
+        filename TEXT NOT NULL
+    )
+    ''')
+
+    # В новой базе сразу есть все разделы правил, файлы к ним загружает админ
+    for command in ('send_pdf_reglament', 'send_pdf_contract', 'send_pdf_ad_rules', 'send_pdf_photo_video_rules'):
+        cursor.execute(
+            "INSERT INTO pdf_files (command, filename) SELECT ?, '' WHERE NOT EXISTS (SELECT 1 FROM pdf_files WHERE command = ?)",
+            (command, command)
+        )
+
+
+# Колонки для file_id документов, уже загруженных в Telegram
+def _data_v2_file_ids(cursor):
+    add_missing_column(cursor, 'houses', 'presentation_file_id', 'TEXT')
+    add_missing_column(cursor, 'pdf_files', 'file_id', 'TEXT')
+
+
+def _data_v3_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_houses_name ON houses (name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_favorite_houses_house_id ON favorite_houses (house_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pdf_files_command ON pdf_files (command)')
+
+
+# Пользователи и рассылки хранятся в общей базе вместе с каталогом
+def _data_v4_users(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+                        user_id INTEGER PRIMARY KEY,
+                        chat_id INTEGER,
+                        phone_number TEXT,
+                        first_name TEXT,
+                        last_name TEXT,
+                        company TEXT,
+                        email TEXT)''')
+
+    # Поиск пользователя при /start идет по chat_id
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_chat_id ON users (chat_id)')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        text TEXT NOT NULL,
+                        admin_chat_id INTEGER,
+                        status TEXT NOT NULL DEFAULT 'running',
+                        last_user_id INTEGER NOT NULL DEFAULT 0,
+                        sent INTEGER NOT NULL DEFAULT 0,
+                        blocked INTEGER NOT NULL DEFAULT 0,
+                        failed INTEGER NOT NULL DEFAULT 0,
+                        started_at REAL,
+                        finished_at REAL)''')
+
+    if not os.path.exists(LEGACY_USERS_DB):
+        return
+
+    # Старая база только читается, после переноса ее можно удалить
+    source = sqlite3.connect(f'file:{LEGACY_USERS_DB}?mode=ro', uri=True)
+    try:
+        tables = {row[0] for row in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'users' in tables:
+            cursor.executemany(
+                'INSERT OR IGNORE INTO users (user_id, chat_id, phone_number, first_name, last_name, company, email) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                source.execute('SELECT user_id, chat_id, phone_number, first_name, last_name, company, email FROM users')
+            )
+        if 'broadcasts' in tables:
+            columns = 'id, text, admin_chat_id, status, last_user_id, sent, blocked, failed, started_at, finished_at'
+            cursor.executemany(
+                f'INSERT OR IGNORE INTO broadcasts ({columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                source.execute(f'SELECT {columns} FROM broadcasts')
+            )
+    finally:
+        source.close()
+    logging.info("Пользователи и рассылки перенесены из %s в общую базу", LEGACY_USERS_DB)
+
+
+# Дом попадает в лоты недели не больше одного раза. Внешние ключи раньше не проверялись,
+# поэтому заодно удаляются лоты уже удаленных домов
+def _data_v5_unique_favorites(cursor):
+    cursor.execute('DELETE FROM favorite_houses WHERE house_id NOT IN (SELECT id FROM houses)')
+    cursor.execute('DELETE FROM favorite_houses WHERE id NOT IN (SELECT MIN(id) FROM favorite_houses GROUP BY house_id)')
+    cursor.execute('DROP INDEX IF EXISTS idx_favorite_houses_house_id')
+    cursor.execute('CREATE UNIQUE INDEX idx_favorite_houses_house_id ON favorite_houses (house_id)')
+
+
+# Версии данных, общие для всех процессов бота, по ним процессы обновляют свои кэши
+def _data_v6_versions(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS data_versions (
+                        name TEXT PRIMARY KEY,
+                        version INTEGER NOT NULL DEFAULT 0)''')
+    cursor.executemany(
+        'INSERT OR IGNORE INTO data_versions (name) VALUES (?)',
+        [('houses',), ('favorites',), ('pdf_files',)]
+    )
+
+
+# Название дома уникально: по нему дом ищется в кэше каталога и в папке презентаций.
+# Повторы, добавленные раньше, получают к названию свой id (или id с номером, если такое название занято).
+# Папка презентаций определяется названием, поэтому файл презентации копируется в папку нового названия
+def _data_v7_unique_house_names(cursor):
+    names = {row[0] for row in cursor.execute('SELECT name FROM houses')}
+    duplicates = cursor.execute('''SELECT id, name, presentation FROM houses
+                                   WHERE id NOT IN (SELECT MIN(id) FROM houses GROUP BY name)
+                                   ORDER BY id''').fetchall()
+    for house_id, name, presentation in duplicates:
+        new_name = f'{name} ({house_id})'
+        number = 2
+        while new_name in names:
+            new_name = f'{name} ({house_id}-{number})'
+            number += 1
+        names.add(new_name)
+        cursor.execute('UPDATE houses SET name = ? WHERE id = ?', (new_name, house_id))
+
+        source = presentation_path(name, presentation) if presentation else None
+        if source and os.path.isfile(source):
+            os.makedirs(os.path.dirname(presentation_path(new_name, presentation)), exist_ok=True)
+            shutil.copy2(source, presentation_path(new_name, presentation))
+            logging.warning("Дом #%s '%s' переименован в '%s', презентация скопирована", house_id, name, new_name)
+        else:
+            logging.warning("Дом #%s '%s' переименован в '%s'", house_id, name, new_name)
+
+    cursor.execute('DROP INDEX IF EXISTS idx_houses_name')
+    cursor.execute('CREATE UNIQUE INDEX idx_houses_name ON houses (name)')
+
+
+# Рассылку ведет один процесс бота: владелец строки и срок его аренды
+def _data_v8_broadcast_lease(cursor):
+    add_missing_column(cursor, 'broadcasts', 'owner', 'TEXT')
+    add_missing_column(cursor, 'broadcasts', 'leased_until', 'REAL')
+
+
+# Версия file_id презентаций: они хранятся в кэше каталога каждого процесса
+def _data_v9_file_ids_version(cursor):
+    cursor.execute("INSERT OR IGNORE INTO data_versions (name) VALUES ('file_ids')")
+
+
+# Аренды фоновых задач, которые выполняет только один процесс бота
+def _data_v10_leases(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS leases (
+                        name TEXT PRIMARY KEY,
+                        owner TEXT NOT NULL,
+                        leased_until REAL NOT NULL)''')
+
+
+DATA_MIGRATIONS = [
+    _data_v1_base_tables,
+    _data_v2_file_ids,
+    _data_v3_indexes,
+    _data_v4_users,
+    _data_v5_unique_favorites,
+    _data_v6_versions,
+    _data_v7_unique_house_names,
+    _data_v8_broadcast_lease,
+    _data_v9_file_ids_version,
+    _data_v10_leases,
+]
+
+
+# Применяет недостающие миграции, каждую в своей транзакции вместе с новым номером версии.
+# Версия перечитывается внутри BEGIN IMMEDIATE, поэтому несколько процессов, запущенных одновременно,
+# не применят одну миграцию дважды. Возвращает номера примененных миграций
+def _apply_migrations(pool, migrations):
+    applied = []
+    with pool.connection() as conn:
+        # Обычный запуск: схема уже актуальна, блокировка на запись не нужна
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= len(migrations):
+            return applied
+
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(migrations):
+                conn.commit()
+                return applied
+
+            migrations[version](conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+            applied.append(version + 1)
+
+
+async def migrate():
+    applied = await run_db(_apply_migrations, data_pool, DATA_MIGRATIONS)
+    if applied:
+        logging.info("Применены миграции базы: %s", ', '.join(map(str, applied)))
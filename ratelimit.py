@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+
+# Ведро токенов: не больше rate действий в секунду с допустимым всплеском до capacity
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Забирает токен без ожидания, False если токенов нет
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    # Ждет, пока появится токен
+    async def acquire(self):
+        async with self._lock:
+            while not self.try_acquire():
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Пауза: следующий токен появится не раньше чем через seconds секунд.
+    # Повторные паузы на то же время не складываются
+    def pause(self, seconds):
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    # Ведро давно не использовалось и снова полное
+    def is_idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+# Отдельное ведро на каждый ключ (например, chat_id), неиспользуемые ведра периодически удаляются
+class KeyedTokenBuckets:
+    def __init__(self, rate, capacity=None, cleanup_every=1000):
+        self.rate = rate
+        self.capacity = capacity
+        self.cleanup_every = cleanup_every
+        self.buckets = {}
+        self._calls = 0
+
+    def get(self, key):
+        self._calls += 1
+        if self._calls % self.cleanup_every == 0:
+            self.buckets = {k: bucket for k, bucket in self.buckets.items() if not bucket.is_idle()}
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+        return bucket
+
+    def try_acquire(self, key):
+        return self.get(key).try_acquire()
+
+    async def acquire(self, key):
+        await self.get(key).acquire()
@@ -0,0 +1,84 @@
+import re
+from collections import defaultdict
+
+from data import data_versions, get_houses_data
+
+
+# Минимальная доля совпавших триграмм запроса, чтобы дом попал в результаты
+MIN_SCORE = 0.4
+
+
+def normalize(text):
+    text = text.lower().replace('ё', 'е')
+    return ' '.join(re.sub(r'[^\w]+', ' ', text).split())
+
+
+# Триграммы слов с пробелами по краям, чтобы начало слова весило больше
+def trigrams(text):
+    result = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            result.add(padded[i:i + 3])
+    return result
+
+
+# Индекс триграмм: нечеткий поиск с опечатками и по части названия
+class TrigramIndex:
+    def __init__(self):
+        # триграмма -> id документов
+        self.postings = defaultdict(set)
+        # id -> (исходный текст, нормализованный текст)
+        self.documents = {}
+
+    def add(self, doc_id, text):
+        self.documents[doc_id] = (text, normalize(text))
+        for trigram in trigrams(text):
+            self.postings[trigram].add(doc_id)
+
+    # Возвращает список (id, текст), лучшие совпадения первыми
+    def search(self, query, min_score=MIN_SCORE):
+        query_trigrams = trigrams(query)
+        if not query_trigrams:
+            return []
+        normalized_query = normalize(query)
+
+        common = defaultdict(int)
+        for trigram in query_trigrams:
+            for doc_id in self.postings.get(trigram, ()):
+                common[doc_id] += 1
+
+        ranked = []
+        for doc_id, count in common.items():
+            score = count / len(query_trigrams)
+            if score < min_score:
+                continue
+            text, normalized_text = self.documents[doc_id]
+            # Точное вхождение и совпадение с началом названия поднимают результат выше
+            if normalized_query in normalized_text:
+                score += 1
+                if normalized_text.startswith(normalized_query):
+                    score += 0.5
+            ranked.append((-score, len(text), text, doc_id))
+
+        ranked.sort()
+        return [(doc_id, text) for _, _, text, doc_id in ranked]
+
+
+# Индекс каталога домов, перестраивается только после изменения каталога
+houses_index = TrigramIndex()
+houses_index_version = None
+
+
+async def search_houses(query):
+    global houses_index, houses_index_version
+
+    version = data_versions['houses']
+    if houses_index_version != version:
+        index = TrigramIndex()
+        for name, info in (await get_houses_data()).items():
+            index.add(info['id'], name)
+        houses_index = index
+        houses_index_version = version
+
+    return houses_index.search(query)
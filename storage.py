@@ -0,0 +1,103 @@
+import json
+import os
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
+
+from data import ConnectionPool, run_db
+
+
+# Хранилище состояний FSM в SQLite: переживает перезапуск и доступно нескольким процессам бота.
+# Любое другое общее хранилище (например, Redis) подключается через тот же интерфейс BaseStorage
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path='fsm.db', key_builder=None):
+        self.pool = ConnectionPool(path)
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+        with self.pool.connection() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS fsm (
+                                key TEXT PRIMARY KEY,
+                                state TEXT,
+                                data TEXT NOT NULL DEFAULT '{}')''')
+
+    def _set_state(self, key, state):
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+                (key, state)
+            )
+
+    def _get_state(self, key):
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT state FROM fsm WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else None
+
+    def _set_data(self, key, data):
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                (key, json.dumps(data, ensure_ascii=False))
+            )
+
+    def _get_data(self, key):
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT data FROM fsm WHERE key = ?', (key,)).fetchone()
+            return json.loads(row[0]) if row else {}
+
+    def _update_data(self, key, data):
+        # Чтение и запись в одной транзакции, чтобы параллельные процессы не затирали данные друг друга
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT data FROM fsm WHERE key = ?', (key,)).fetchone()
+            current = json.loads(row[0]) if row else {}
+            current.update(data)
+            conn.execute(
+                "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+                (key, json.dumps(current, ensure_ascii=False))
+            )
+            return current
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await run_db(self._set_state, self.key_builder.build(key), state)
+
+    async def get_state(self, key):
+        return await run_db(self._get_state, self.key_builder.build(key))
+
+    async def set_data(self, key, data):
+        await run_db(self._set_data, self.key_builder.build(key), data)
+
+    async def get_data(self, key):
+        return await run_db(self._get_data, self.key_builder.build(key))
+
+    async def update_data(self, key, data):
+        return await run_db(self._update_data, self.key_builder.build(key), data)
+
+    async def close(self):
+        self.pool.close()
+
+
+# Выбор хранилища по переменной FSM_STORAGE:
+# путь к файлу SQLite (по умолчанию fsm.db), "memory" или адрес redis://...
+def create_storage():
+    url = os.getenv("FSM_STORAGE", "fsm.db")
+
+    if url == "memory":
+        return MemoryStorage()
+
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        # Для Redis нужен пакет redis, импортируем его только при необходимости
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(url, key_builder=DefaultKeyBuilder(with_destiny=True))
+
+    return SQLiteStorage(url)
+
+
+# Блокировка обновлений одного пользователя в чате: следующее обновление ждет, пока обработается предыдущее,
+# поэтому шаги регистрации и другие переходы FSM не перемешиваются. Обновления разных чатов идут параллельно.
+# С Redis блокировка общая для всех процессов бота, иначе действует внутри одного процесса
+def create_events_isolation(storage):
+    if hasattr(storage, "create_isolation"):
+        return storage.create_isolation()
+    return SimpleEventIsolation()
@@ -0,0 +1,47 @@
+import asyncio
+
+import broadcast
+from data import ConnectionPool
+from migrations import _apply_migrations, DATA_MIGRATIONS
+
+
+def make_pool(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = ConnectionPool(str(tmp_path / 'data.db'))
+    _apply_migrations(pool, DATA_MIGRATIONS)
+    monkeypatch.setattr(broadcast, 'data_pool', pool)
+    return pool
+
+
+def test_running_broadcast_is_claimed_by_one_process(tmp_path, monkeypatch):
+    pool = make_pool(tmp_path, monkeypatch)
+    broadcast_id = broadcast._insert_broadcast('Лот недели', None, 'old')
+
+    # Аренда процесса, который начал рассылку, еще действует
+    assert not broadcast._claim_broadcast(broadcast_id, 'a')
+
+    with pool.connection() as conn:
+        conn.execute('UPDATE broadcasts SET leased_until = 0 WHERE id = ?', (broadcast_id,))
+        conn.commit()
+    assert broadcast._claim_broadcast(broadcast_id, 'a')
+    assert not broadcast._claim_broadcast(broadcast_id, 'b')
+
+    # Прогресс сохраняет только владелец
+    assert not broadcast._save_progress(broadcast_id, 'b', 10, 1, 0, 0)
+    assert broadcast._save_progress(broadcast_id, 'a', 10, 1, 0, 0)
+
+    broadcast._release_broadcast(broadcast_id, 'a')
+    assert broadcast._claim_broadcast(broadcast_id, 'b')
+    pool.close()
+
+
+def test_resume_skips_broadcast_of_another_process(tmp_path, monkeypatch):
+    pool = make_pool(tmp_path, monkeypatch)
+    broadcast._insert_broadcast('Лот недели', None, 'other')
+
+    async def run():
+        broadcaster = broadcast.Broadcaster(bot=None)
+        return await broadcaster.resume()
+
+    assert asyncio.run(run()) == []
+    pool.close()
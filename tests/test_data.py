@@ -0,0 +1,121 @@
+import asyncio
+
+import data
+
+
+def test_user_write_queue_batches_and_replaces_rows(monkeypatch):
+    written = []
+    monkeypatch.setattr(data, '_upsert_users', lambda rows: written.append(list(rows)))
+
+    async def run():
+        queue = data.UserWriteQueue(batch_size=3, flush_interval=60)
+        await queue.put((1, 10, '+7', 'Анна', '', '', ''))
+        await queue.put((1, 10, '+7', 'Аня', '', '', ''))
+        await queue.put((2, 20, '+7', 'Иван', '', '', ''))
+        assert written == []
+        assert queue.pending_first_name(10) == 'Аня'
+
+        await queue.put((3, 30, '+7', 'Петр', '', '', ''))
+        assert [row[0] for row in written[0]] == [1, 2, 3]
+        assert queue.pending == {}
+
+    asyncio.run(run())
+
+
+def test_user_write_queue_flushes_by_timer(monkeypatch):
+    written = []
+    monkeypatch.setattr(data, '_upsert_users', lambda rows: written.append(list(rows)))
+
+    async def run():
+        queue = data.UserWriteQueue(batch_size=100, flush_interval=0.01)
+        await queue.put((1, 10, '+7', 'Анна', '', '', ''))
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert [row[0] for rows in written for row in rows] == [1]
+
+
+def test_user_write_queue_keeps_rows_on_error(monkeypatch):
+    def fail(rows):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(data, '_upsert_users', fail)
+
+    async def run():
+        queue = data.UserWriteQueue(batch_size=100, flush_interval=60)
+        await queue.put((1, 10, '+7', 'Анна', '', '', ''))
+        try:
+            await queue.flush()
+        except RuntimeError:
+            pass
+        return queue.pending
+
+    assert list(asyncio.run(run())) == [1]
+
+
+def test_user_write_queue_retries_failed_background_flush(monkeypatch):
+    written = []
+    failures = [RuntimeError('database is locked')]
+
+    def upsert(rows):
+        if failures:
+            raise failures.pop()
+        written.append(list(rows))
+
+    monkeypatch.setattr(data, '_upsert_users', upsert)
+
+    async def run():
+        queue = data.UserWriteQueue(batch_size=100, flush_interval=0.01)
+        await queue.put((1, 10, '+7', 'Анна', '', '', ''))
+        await asyncio.sleep(0.1)
+        return queue.pending
+
+    assert asyncio.run(run()) == {}
+    assert [row[0] for rows in written for row in rows] == [1]
+
+
+def test_file_id_is_saved_only_for_the_scanned_file(tmp_path, monkeypatch):
+    from migrations import _apply_migrations, DATA_MIGRATIONS
+
+    monkeypatch.chdir(tmp_path)
+    pool = data.ConnectionPool(str(tmp_path / 'data.db'))
+    _apply_migrations(pool, DATA_MIGRATIONS)
+    monkeypatch.setattr(data, 'data_pool', pool)
+    with pool.connection() as conn:
+        conn.execute("INSERT INTO houses (name, presentation) VALUES ('Парк', 'new.pdf')")
+        conn.execute("UPDATE pdf_files SET filename = 'new.pdf' WHERE command = 'send_pdf_contract'")
+        conn.commit()
+
+    async def run():
+        # Пока старый файл загружался, админ заменил его на new.pdf
+        assert not await data.set_presentation_file_id('Парк', 'old-id', presentation='old.pdf')
+        assert not await data.set_pdf_file_id('send_pdf_contract', 'old-id', filename='old.pdf')
+        assert await data.set_presentation_file_id('Парк', 'new-id', presentation='new.pdf')
+        assert await data.set_pdf_file_id('send_pdf_contract', 'new-id', filename='new.pdf')
+
+    asyncio.run(run())
+    with pool.connection() as conn:
+        assert conn.execute("SELECT presentation_file_id FROM houses WHERE name = 'Парк'").fetchone()[0] == 'new-id'
+        assert conn.execute("SELECT file_id FROM pdf_files WHERE command = 'send_pdf_contract'").fetchone()[0] == 'new-id'
+        # Остальные процессы перечитывают file_id презентаций по версии file_ids
+        assert conn.execute("SELECT version FROM data_versions WHERE name = 'file_ids'").fetchone()[0] == 1
+    pool.close()
+
+
+def test_lease_has_one_owner(tmp_path, monkeypatch):
+    from migrations import _apply_migrations, DATA_MIGRATIONS
+
+    monkeypatch.chdir(tmp_path)
+    pool = data.ConnectionPool(str(tmp_path / 'data.db'))
+    _apply_migrations(pool, DATA_MIGRATIONS)
+    monkeypatch.setattr(data, 'data_pool', pool)
+
+    assert data._acquire_lease('scanner', 'a', 30)
+    assert data._acquire_lease('scanner', 'a', 30)
+    assert not data._acquire_lease('scanner', 'b', 30)
+
+    # Аренда истекла: процесс a остановлен
+    assert data._acquire_lease('scanner', 'a', -1)
+    assert data._acquire_lease('scanner', 'b', 30)
+    assert not data._acquire_lease('scanner', 'a', 30)
+    pool.close()
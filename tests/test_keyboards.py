@@ -0,0 +1,33 @@
+from callbacks import ListPage
+from keyboards import houses_page, PAGE_SIZE
+
+
+def make_houses(ids):
+    return {f'house{house_id}': {'id': house_id} for house_id in ids}
+
+
+def test_houses_page_first_page():
+    houses = make_houses(range(1, 26))
+    page, navigation = houses_page(houses, 'houses', 0)
+
+    assert [house_id for house_id, _ in page] == list(range(1, PAGE_SIZE + 1))
+    assert [ListPage.unpack(button.callback_data).start_id for button in navigation] == [PAGE_SIZE + 1]
+
+
+def test_houses_page_middle_and_last_page():
+    houses = make_houses(range(1, 26))
+
+    page, navigation = houses_page(houses, 'houses', 11)
+    assert [house_id for house_id, _ in page] == list(range(11, 21))
+    assert [ListPage.unpack(button.callback_data).start_id for button in navigation] == [1, 21]
+
+    page, navigation = houses_page(houses, 'houses', 21)
+    assert [house_id for house_id, _ in page] == list(range(21, 26))
+    assert [ListPage.unpack(button.callback_data).start_id for button in navigation] == [11]
+
+
+def test_houses_page_start_id_of_deleted_house():
+    # Дом, с которого начиналась страница, удален: страница начинается со следующего
+    houses = make_houses([1, 2, 5, 7])
+    page, _ = houses_page(houses, 'houses', 3)
+    assert [house_id for house_id, _ in page] == [5, 7]
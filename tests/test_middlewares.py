@@ -0,0 +1,40 @@
+import asyncio
+
+from middlewares import InFlightMiddleware, ThrottlingMiddleware
+
+
+def test_in_flight_waits_for_running_updates():
+    async def run():
+        in_flight = InFlightMiddleware()
+        release = asyncio.Event()
+
+        async def handler(event, data):
+            await release.wait()
+
+        task = asyncio.create_task(in_flight(handler, None, {}))
+        await asyncio.sleep(0)
+        assert in_flight.active == 1
+        assert not await in_flight.wait_idle(0.01)
+
+        release.set()
+        assert await in_flight.wait_idle(1)
+        await task
+        assert in_flight.active == 0
+
+    asyncio.run(run())
+
+
+def test_only_repeat_of_previous_tap_is_duplicate():
+    throttling = ThrottlingMiddleware()
+
+    assert not throttling._is_duplicate(1, 'houses_for_sale')
+    assert throttling._is_duplicate(1, 'houses_for_sale')
+
+    # Список -> дом -> назад к списку: каждое нажатие обрабатывается
+    assert not throttling._is_duplicate(2, 'houses_for_sale')
+    assert not throttling._is_duplicate(2, 'house:1')
+    assert not throttling._is_duplicate(2, 'houses_for_sale')
+
+    # Повтор после окна склейки - новое нажатие
+    throttling.last_taps[2] = ('houses_for_sale', throttling.last_taps[2][1] - throttling.duplicate_window)
+    assert not throttling._is_duplicate(2, 'houses_for_sale')
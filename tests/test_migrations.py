@@ -0,0 +1,90 @@
+from data import ConnectionPool
+from migrations import _apply_migrations, DATA_MIGRATIONS
+
+
+def user_version(pool):
+    with pool.connection() as conn:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def test_apply_migrations_once(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'test.db'))
+    calls = []
+    migrations = [
+        lambda cursor: calls.append(1) or cursor.execute('CREATE TABLE a (x INTEGER)'),
+        lambda cursor: calls.append(2) or cursor.execute('ALTER TABLE a ADD COLUMN y INTEGER'),
+    ]
+
+    assert _apply_migrations(pool, migrations) == [1, 2]
+    assert _apply_migrations(pool, migrations) == []
+    assert calls == [1, 2]
+    assert user_version(pool) == 2
+
+    # Новая миграция в конце списка применяется отдельно
+    migrations.append(lambda cursor: calls.append(3))
+    assert _apply_migrations(pool, migrations) == [3]
+    pool.close()
+
+
+def test_failed_migration_is_rolled_back(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'test.db'))
+
+    def broken(cursor):
+        cursor.execute('CREATE TABLE b (x INTEGER)')
+        raise RuntimeError('broken migration')
+
+    try:
+        _apply_migrations(pool, [lambda cursor: cursor.execute('CREATE TABLE a (x INTEGER)'), broken])
+    except RuntimeError:
+        pass
+    assert user_version(pool) == 1
+    with pool.connection() as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert tables == {'a'}
+    pool.close()
+
+
+def test_data_migrations_on_empty_database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = ConnectionPool(str(tmp_path / 'data.db'))
+    assert _apply_migrations(pool, DATA_MIGRATIONS) == list(range(1, len(DATA_MIGRATIONS) + 1))
+    with pool.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM pdf_files').fetchone()[0] == 4
+    pool.close()
+
+
+def test_duplicate_house_names_are_renamed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = ConnectionPool(str(tmp_path / 'data.db'))
+    _apply_migrations(pool, DATA_MIGRATIONS[:6])
+    with pool.connection() as conn:
+        conn.executemany(
+            'INSERT INTO houses (id, name, presentation) VALUES (?, ?, ?)',
+            [(1, 'Парк', 'park.pdf'), (2, 'Парк', 'park.pdf'), (3, 'Парк (3)', ''), (4, 'Парк', '')]
+        )
+        conn.commit()
+    (tmp_path / 'Парк').mkdir()
+    (tmp_path / 'Парк' / 'park.pdf').write_bytes(b'pdf')
+
+    assert _apply_migrations(pool, DATA_MIGRATIONS)[0] == 7
+    with pool.connection() as conn:
+        names = [row[0] for row in conn.execute('SELECT name FROM houses ORDER BY id')]
+    assert names == ['Парк', 'Парк (2)', 'Парк (3)', 'Парк (4)']
+    # Переименованный дом находит свою презентацию в папке нового названия
+    assert (tmp_path / 'Парк (2)' / 'park.pdf').read_bytes() == b'pdf'
+    pool.close()
+
+
+def test_generated_house_name_is_free(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = ConnectionPool(str(tmp_path / 'data.db'))
+    _apply_migrations(pool, DATA_MIGRATIONS[:6])
+    with pool.connection() as conn:
+        conn.executemany('INSERT INTO houses (id, name) VALUES (?, ?)', [(1, 'Сад'), (2, 'Сад (3)'), (3, 'Сад')])
+        conn.commit()
+
+    _apply_migrations(pool, DATA_MIGRATIONS)
+    with pool.connection() as conn:
+        names = [row[0] for row in conn.execute('SELECT name FROM houses ORDER BY id')]
+    assert names == ['Сад', 'Сад (3)', 'Сад (3-2)']
+    pool.close()
@@ -0,0 +1,43 @@
+import asyncio
+
+from ratelimit import TokenBucket, KeyedTokenBuckets
+
+
+def test_token_bucket_burst_and_refill():
+    bucket = TokenBucket(rate=10, capacity=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+
+    bucket.updated_at -= 0.1
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+
+def test_token_bucket_acquire_waits():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=1)
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        await bucket.acquire()
+        await bucket.acquire()
+        return loop.time() - started_at
+
+    assert asyncio.run(run()) >= 0.015
+
+
+def test_keyed_buckets_are_independent():
+    buckets = KeyedTokenBuckets(rate=1, capacity=1)
+    assert buckets.try_acquire('a')
+    assert not buckets.try_acquire('a')
+    assert buckets.try_acquire('b')
+
+
+def test_token_bucket_pause():
+    bucket = TokenBucket(rate=10, capacity=3)
+    bucket.pause(0.5)
+    bucket.pause(0.5)
+    assert not bucket.try_acquire()
+
+    bucket.updated_at -= 0.45
+    assert not bucket.try_acquire()
+    bucket.updated_at -= 0.1
+    assert bucket.try_acquire()
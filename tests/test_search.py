@@ -0,0 +1,26 @@
+from search import TrigramIndex, normalize
+
+
+def make_index():
+    index = TrigramIndex()
+    for doc_id, name in enumerate(['Новая Ливадия', 'Массандра Парк', 'Ливадийский сад'], start=1):
+        index.add(doc_id, name)
+    return index
+
+
+def test_normalize():
+    assert normalize('  Ёлки-Палки!! ') == 'елки палки'
+
+
+def test_search_prefers_exact_match():
+    results = make_index().search('ливадия')
+    assert results[0] == (1, 'Новая Ливадия')
+
+
+def test_search_with_typo():
+    assert make_index().search('масандра')[0] == (2, 'Массандра Парк')
+
+
+def test_search_nothing_found():
+    assert make_index().search('zzz') == []
+    assert make_index().search('') == []
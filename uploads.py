@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+
+from aiogram.exceptions import TelegramAPIError
+
+from metrics import transfer_bytes_total
+
+
+# Bot API отдает ботам файлы не больше 20 МБ
+MAX_FILE_SIZE = 20 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 300
+
+# Как часто обновляем сообщение с прогрессом, в секундах
+PROGRESS_INTERVAL = 2
+
+# Запущенные загрузки, чтобы задачи не удалил сборщик мусора
+upload_tasks = set()
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+# Запись во временный файл с подсчетом размера и контрольной суммы на лету
+class ChecksumWriter:
+    def __init__(self, file, limit=MAX_FILE_SIZE):
+        self.file = file
+        self.limit = limit
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.limit:
+            raise FileTooLarge()
+        self.sha256.update(chunk)
+        self.file.write(chunk)
+        transfer_bytes_total.inc(len(chunk), direction='download')
+
+    def flush(self):
+        self.file.flush()
+
+
+def file_sha256(path):
+    if not path or not os.path.isfile(path):
+        return None
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+
+# Имя файла от пользователя без каталогов
+def safe_file_name(document):
+    return os.path.basename(document.file_name or '') or f"{document.file_unique_id}.pdf"
+
+
+async def _report_progress(writer, total, on_progress):
+    reported = None
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        if writer.size != reported:
+            reported = writer.size
+            try:
+                await on_progress(writer.size, total)
+            except TelegramAPIError:
+                pass
+
+
+# Скачивает документ во временный файл рядом с destination и атомарно подменяет им destination,
+# поэтому читатели никогда не видят недописанный файл.
+# Если содержимое совпадает с compare_with (по умолчанию с destination), файл не трогается и возвращается False
+async def download_document(bot, document, destination, compare_with=None, on_progress=None):
+    directory = os.path.dirname(destination) or '.'
+    await asyncio.to_thread(os.makedirs, directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer = ChecksumWriter(f)
+            reporter = None
+            if on_progress:
+                reporter = asyncio.create_task(_report_progress(writer, document.file_size, on_progress))
+            try:
+                await bot.download(document, destination=writer, timeout=DOWNLOAD_TIMEOUT, chunk_size=CHUNK_SIZE, seek=False)
+            finally:
+                if reporter:
+                    reporter.cancel()
+
+        old_sha256 = await asyncio.to_thread(file_sha256, compare_with or destination)
+        if old_sha256 == writer.sha256.hexdigest():
+            os.remove(tmp_path)
+            return False
+
+        # mkstemp создает файл только для владельца, а отдаваемые файлы должны быть доступны как обычно
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, destination)
+        return True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Загрузка файла от админа в фоне: обработчик сразу освобождается, прогресс виден в отдельном сообщении.
+# on_done(changed) вызывается после загрузки и возвращает текст итогового сообщения
+async def start_upload(message, document, destination, on_done, compare_with=None, reply_markup=None):
+    if document.file_size and document.file_size > MAX_FILE_SIZE:
+        await message.answer(
+            f"Файл слишком большой: {format_size(document.file_size)}, максимум {format_size(MAX_FILE_SIZE)}.",
+            reply_markup=reply_markup
+        )
+        return None
+
+    file_name = safe_file_name(document)
+    status = await message.answer(f"Загрузка {file_name}...")
+
+    async def on_progress(received, total):
+        if total:
+            await status.edit_text(f"Загрузка {file_name}: {format_size(received)} из {format_size(total)}")
+        else:
+            await status.edit_text(f"Загрузка {file_name}: {format_size(received)}")
+
+    async def run():
+        try:
+            changed = await download_document(message.bot, document, destination, compare_with, on_progress)
+            text = await on_done(changed)
+        except FileTooLarge:
+            text = f"Файл слишком большой, максимум {format_size(MAX_FILE_SIZE)}."
+        except Exception:
+            logging.exception("Не удалось загрузить %s", destination)
+            text = "Не удалось загрузить файл, попробуйте еще раз."
+
+        try:
+            await status.edit_text(text, reply_markup=reply_markup)
+        except TelegramAPIError:
+            await message.answer(text, reply_markup=reply_markup)
+
+    task = asyncio.create_task(run())
+    upload_tasks.add(task)
+    task.add_done_callback(upload_tasks.discard)
+    return task